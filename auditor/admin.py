@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import HITType, HIT, Worker, Assignment, AssignmentDuration, AssignmentAudit
+from .models import HITType, HIT, Worker, Assignment, AssignmentDuration, AssignmentAudit, BonusPayment
 
 admin.site.register(HITType)
 admin.site.register(HIT)
@@ -8,3 +8,4 @@ admin.site.register(Worker)
 admin.site.register(Assignment)
 admin.site.register(AssignmentDuration)
 admin.site.register(AssignmentAudit)
+admin.site.register(BonusPayment)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class AuditorConfig(AppConfig):
     name = 'auditor'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,283 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+import hashlib
+import json
+import re
+import threading
+import time
+
+"""
+A stand-in for the MTurk requester API, for load tests and local development. It speaks
+the same JSON protocol as MTurk, so boto3 clients talk to it unchanged: run it with the
+fakemturk command and point MTURK_ENDPOINT and MTURK_SANDBOX_ENDPOINT at it.
+
+Assignments and HITs can be registered explicitly. With a synthetic status mix, any
+assignment it hasn't been told about gets a status derived from a hash of its id, so
+millions of assignments need no setup and give the same answers on every run.
+"""
+
+API_PREFIX = 'MTurkRequesterServiceV20170117.'
+STATUSES = ['Submitted', 'Approved', 'Rejected', 'Open', 'Missing'] # Open: still checked out or returned. Missing: MTurk never heard of it
+BONUS_FEE_RATE = Decimal('0.20')
+AUTO_APPROVAL_DELAY = 3*24*60*60
+ASSIGNMENT_DURATION = 60*60
+
+class FakeMTurkError(Exception):
+    def __init__(self, message, code = 'RequestError', status = 400):
+        super(FakeMTurkError, self).__init__(message)
+        self.message = message
+        self.code = code
+        self.status = status
+
+class FakeMTurk:
+    """
+    The fake's state. All operations are thread-safe.
+
+    synthetic: {status: weight} over STATUSES for assignments that weren't registered, or None
+        to treat unregistered assignments as unknown
+    latency: seconds added to every call
+    throttle_rate: calls per second per access key above which calls fail with ThrottlingException, or None
+    balance: starting balance of every account, in dollars
+    """
+    def __init__(self, synthetic = None, latency = 0, throttle_rate = None, balance = '10000.00'):
+        self.synthetic = synthetic
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.initial_balance = Decimal(balance)
+
+        self.lock = threading.Lock()
+        self.assignments = dict() # id -> {'HITId', 'WorkerId', 'AssignmentStatus'}
+        self.hit_assignments = defaultdict(list) # HIT id -> assignment ids, for ListAssignmentsForHIT
+        self.hits = dict() # id -> {'HITTypeId', 'Reward', ...}
+        self.balances = dict() # access key -> Decimal
+        self.bonuses = dict() # UniqueRequestToken -> bonus
+        self.notifications = [] # (subject, worker ids)
+        self.calls = defaultdict(int) # operation -> count
+        self.recent_calls = defaultdict(list) # access key -> times of calls in the last second
+
+    def add_hit(self, hit_id, hit_type_id, reward = '0.50', assignment_duration = ASSIGNMENT_DURATION, auto_approval_delay = AUTO_APPROVAL_DELAY):
+        with self.lock:
+            self.hits[hit_id] = {
+                'HITId': hit_id,
+                'HITTypeId': hit_type_id,
+                'Reward': reward,
+                'AssignmentDurationInSeconds': assignment_duration,
+                'AutoApprovalDelayInSeconds': auto_approval_delay,
+            }
+
+    def add_assignment(self, assignment_id, hit_id, worker_id, status = None):
+        """
+        Registers an assignment. Leave status out to use the synthetic mix.
+        """
+        with self.lock:
+            if assignment_id not in self.assignments:
+                self.hit_assignments[hit_id].append(assignment_id)
+            self.assignments[assignment_id] = {'HITId': hit_id, 'WorkerId': worker_id, 'AssignmentStatus': status}
+
+    def set_status(self, assignment_id, status):
+        with self.lock:
+            self.assignments[assignment_id]['AssignmentStatus'] = status
+
+    def set_balance(self, access_key, balance):
+        with self.lock:
+            self.balances[access_key] = Decimal(balance)
+
+    def handle(self, operation, params, access_key):
+        """
+        Runs one API call. Returns the response dict or raises FakeMTurkError.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[operation] += 1
+            self.__throttle(access_key)
+            method = getattr(self, '_op_%s' % operation, None)
+            if method is None:
+                raise FakeMTurkError('Operation %s is not supported by the fake.' % operation, code = 'ServiceFault', status = 500)
+            return method(params, access_key)
+
+    def __throttle(self, access_key):
+        if not self.throttle_rate:
+            return
+        now = time.time()
+        recent = [t for t in self.recent_calls[access_key] if t > now - 1]
+        if len(recent) >= self.throttle_rate:
+            self.recent_calls[access_key] = recent
+            raise FakeMTurkError('Rate exceeded', code = 'ThrottlingException')
+        recent.append(now)
+        self.recent_calls[access_key] = recent
+
+    ###
+    ### Lookups. Callers hold the lock.
+    ###
+    def __assignment(self, assignment_id):
+        if assignment_id in self.assignments:
+            assignment = dict(self.assignments[assignment_id], AssignmentId = assignment_id)
+            if assignment['AssignmentStatus'] is None:
+                assignment['AssignmentStatus'] = self.__synthetic_status(assignment_id)
+        elif self.synthetic:
+            status = self.__synthetic_status(assignment_id)
+            assignment = {'AssignmentId': assignment_id, 'HITId': 'HIT' + assignment_id, 'WorkerId': 'WORKER' + assignment_id, 'AssignmentStatus': status}
+        else:
+            assignment = None
+
+        if assignment is None or assignment['AssignmentStatus'] == 'Missing':
+            return None
+        if assignment['AssignmentStatus'] != 'Open':
+            hit = self.__hit(assignment['HITId'])
+            submit_time = time.time() - 60
+            assignment['SubmitTime'] = submit_time
+            assignment['AutoApprovalTime'] = submit_time + (hit['AutoApprovalDelayInSeconds'] if hit is not None else AUTO_APPROVAL_DELAY)
+        return assignment
+
+    def __synthetic_status(self, assignment_id):
+        weights = self.synthetic or {'Open': 1}
+        point = hash_fraction(assignment_id) * sum(weights.values())
+        for status in STATUSES:
+            point -= weights.get(status, 0)
+            if point < 0:
+                return status
+        return 'Open'
+
+    def __hit(self, hit_id):
+        if hit_id in self.hits:
+            return dict(self.hits[hit_id])
+        elif self.synthetic or hit_id in self.hit_assignments:
+            return {
+                'HITId': hit_id,
+                'HITTypeId': 'HITTYPE' + hashlib.md5(hit_id.encode('utf-8')).hexdigest()[:8].upper(),
+                'Reward': '0.50',
+                'AssignmentDurationInSeconds': ASSIGNMENT_DURATION,
+                'AutoApprovalDelayInSeconds': AUTO_APPROVAL_DELAY,
+            }
+        return None
+
+    def __balance(self, access_key):
+        if access_key not in self.balances:
+            self.balances[access_key] = self.initial_balance
+        return self.balances[access_key]
+
+    ###
+    ### Operations
+    ###
+    def _op_GetAssignment(self, params, access_key):
+        assignment = self.__assignment(params['AssignmentId'])
+        if assignment is None:
+            raise FakeMTurkError('Assignment %s does not exist. (%d)' % (params['AssignmentId'], time.time() * 1000))
+        if assignment['AssignmentStatus'] == 'Open':
+            raise FakeMTurkError('This operation can be called with a status of: Reviewable,Approved,Rejected (%d)' % (time.time() * 1000))
+        return {'Assignment': assignment, 'HIT': self.__hit(assignment['HITId'])}
+
+    def _op_GetHIT(self, params, access_key):
+        hit = self.__hit(params['HITId'])
+        if hit is None:
+            raise FakeMTurkError('Hit %s does not exist. (%d)' % (params['HITId'], time.time() * 1000))
+        return {'HIT': hit}
+
+    def _op_ListAssignmentsForHIT(self, params, access_key):
+        if self.__hit(params['HITId']) is None:
+            raise FakeMTurkError('Hit %s does not exist. (%d)' % (params['HITId'], time.time() * 1000))
+        statuses = params.get('AssignmentStatuses', ['Submitted', 'Approved', 'Rejected'])
+        assignments = [self.__assignment(assignment_id) for assignment_id in self.hit_assignments.get(params['HITId'], [])]
+        assignments = [assignment for assignment in assignments if assignment is not None and assignment['AssignmentStatus'] in statuses]
+        return page(assignments, 'Assignments', params)
+
+    def _op_SendBonus(self, params, access_key):
+        token = params.get('UniqueRequestToken')
+        if token is not None and token in self.bonuses:
+            raise FakeMTurkError('The idempotency token "%s" has already been processed. (%d)' % (token, time.time() * 1000))
+        # only registered assignments have a known HIT, which ListBonusPayments(HITId) looks bonuses up by
+        assignment = self.assignments.get(params['AssignmentId'])
+        if assignment is None:
+            raise FakeMTurkError('Assignment %s does not exist. (%d)' % (params['AssignmentId'], time.time() * 1000))
+
+        amount = Decimal(params['BonusAmount'])
+        fee = max(Decimal('0.01'), (amount * BONUS_FEE_RATE).quantize(Decimal('0.01'), rounding = ROUND_HALF_UP))
+        balance = self.__balance(access_key)
+        if balance < amount + fee:
+            raise FakeMTurkError('This Requester has insufficient funds in their account to complete this transaction. (%d)' % (time.time() * 1000))
+        self.balances[access_key] = balance - amount - fee
+
+        self.bonuses[token if token is not None else 'untokened-%d' % len(self.bonuses)] = {
+            'WorkerId': params['WorkerId'],
+            'BonusAmount': params['BonusAmount'],
+            'AssignmentId': params['AssignmentId'],
+            'HITId': assignment['HITId'],
+            'Reason': params['Reason'],
+            'GrantTime': time.time(),
+        }
+        return {}
+
+    def _op_ListBonusPayments(self, params, access_key):
+        if ('HITId' in params) == ('AssignmentId' in params):
+            raise FakeMTurkError('Exactly one of HITId and AssignmentId must be provided. (%d)' % (time.time() * 1000))
+        if 'HITId' in params:
+            if self.__hit(params['HITId']) is None:
+                raise FakeMTurkError('Hit %s does not exist. (%d)' % (params['HITId'], time.time() * 1000))
+            bonuses = [bonus for bonus in self.bonuses.values() if bonus['HITId'] == params['HITId']]
+        else:
+            bonuses = [bonus for bonus in self.bonuses.values() if bonus['AssignmentId'] == params['AssignmentId']]
+        bonuses = [dict((key, bonus[key]) for key in ('WorkerId', 'BonusAmount', 'AssignmentId', 'Reason', 'GrantTime')) for bonus in bonuses]
+        return page(bonuses, 'BonusPayments', params)
+
+    def _op_NotifyWorkers(self, params, access_key):
+        if len(params['WorkerIds']) > 100:
+            raise FakeMTurkError('WorkerIds may contain at most 100 workers. (%d)' % (time.time() * 1000))
+        self.notifications.append((params['Subject'], list(params['WorkerIds'])))
+        return {'NotifyWorkersFailureStatuses': []}
+
+    def _op_GetAccountBalance(self, params, access_key):
+        return {'AvailableBalance': '%.2f' % self.__balance(access_key)}
+
+
+def hash_fraction(s):
+    # a stable stand-in for a random number in [0, 1)
+    return int(hashlib.md5(s.encode('utf-8')).hexdigest()[:12], 16) / float(16 ** 12)
+
+def page(items, key, params):
+    start = int(params.get('NextToken') or 0)
+    max_results = params.get('MaxResults', 100)
+    items = items[start:start + max_results]
+    response = {key: items, 'NumResults': len(items)}
+    if len(items) == max_results:
+        response['NextToken'] = str(start + max_results)
+    return response
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FakeMTurkRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        target = self.headers.get('X-Amz-Target', '')
+        access_key = re.search(r'Credential=([^/,]+)', self.headers.get('Authorization', ''))
+        access_key = access_key.group(1) if access_key else ''
+        params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+        try:
+            body = self.server.fake.handle(target[len(API_PREFIX):], params, access_key)
+            status = 200
+        except FakeMTurkError as e:
+            body = {'__type': e.code, 'Message': e.message}
+            status = e.status
+
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass # thousands of calls a second would drown the console
+
+def make_server(fake, host = '127.0.0.1', port = 0):
+    """
+    Returns an HTTP server for the fake; call serve_forever() on it, from a thread
+    if need be. Port 0 picks a free port, which is then in server.server_address.
+    """
+    server = ThreadingHTTPServer((host, port), FakeMTurkRequestHandler)
+    server.fake = fake
+    return server
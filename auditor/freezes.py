@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import RequesterFreeze
+
+"""
+Answers "has this requester frozen this worker?" without scanning RequesterFreeze.
+Each requester's frozen workers are read in one indexed query and kept in the Django
+cache as a set, so every later check is a set lookup. The signals in auditor.signals
+drop a requester's entry whenever one of their freezes is created or deleted.
+
+With a per-process cache (Django's local-memory cache), other processes only see a
+freeze once their entry expires, after FREEZE_CACHE_TIMEOUT seconds. Use a shared
+cache such as memcached if the web server and the commands must agree immediately.
+"""
+
+def get_frozen_workers(requester_id):
+    """
+    Returns the ids of the workers that the requester has frozen, as a frozenset
+    """
+    cache = caches[getattr(settings, 'FREEZE_CACHE', 'default')]
+    cache_key = frozen_workers_key(requester_id)
+    worker_ids = cache.get(cache_key)
+    if worker_ids is None:
+        worker_ids = frozenset(RequesterFreeze.objects.filter(requester_id = requester_id).values_list('worker_id', flat = True))
+        cache.set(cache_key, worker_ids, getattr(settings, 'FREEZE_CACHE_TIMEOUT', 5*60))
+    return worker_ids
+
+def is_worker_frozen(requester_id, worker_id):
+    return worker_id in get_frozen_workers(requester_id)
+
+def invalidate_frozen_workers(requester_id):
+    caches[getattr(settings, 'FREEZE_CACHE', 'default')].delete(frozen_workers_key(requester_id))
+
+def frozen_workers_key(requester_id):
+    return 'frozen-workers:%s' % requester_id
@@ -1,11 +1,13 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.db.models import Avg, Sum, F, Q
+from django.db import connection, connections, transaction
+from django.db.models import Avg, Sum, F, Q, Case, When, Value, DecimalField
 from django.core.mail import send_mail
 from django.utils import timezone
 from django.template.defaultfilters import pluralize
 from django.core.signing import Signer
 from django.urls import reverse
+import django
 
 
 from statistics import median
@@ -14,11 +16,13 @@ from decimal import Decimal
 import math
 import itertools
 from datetime import timedelta
+from collections import defaultdict
+import io
+import multiprocessing
 
-import boto3
-
-from auditor.models import HITType, HIT, Worker, Assignment, AssignmentDuration, AssignmentAudit, Requester, RequesterFreeze
-from auditor.management.commands.pullnotifications import get_mturk_connection
+from auditor.models import HITType, HIT, Assignment, AssignmentDuration, AssignmentAudit, Requester, AuditWatermark, HITDurationSummary, HITTypeDurationSummary, BonusPayment
+from auditor import freezes
+from auditor.summaries import rebuild_summaries
 
 """
 Performs the payment audit on the task. Pseudocode:
@@ -31,128 +35,244 @@ Performs the payment audit on the task. Pseudocode:
 class Command(BaseCommand):
     help = 'Calculate effective rate for tasks and audit any underpayment'
 
-    mturk = dict() # maintains the Boto client connections
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Re-audit every HIT Type, not just the ones that changed since the last run')
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'AUDIT_WORKERS', 1), help='Number of processes to audit requesters in, with sandbox and production in parallel')
 
     def handle(self, *args, **options):
+        # Anything that changes after this point gets picked up by the next run
+        passes = []
         for is_sandbox in [True, False]:
-            self.stdout.write(self.style.WARNING('Sandbox mode: %s' % is_sandbox))
-            self.__audit_hits(is_sandbox)
-            self.__notify_requesters(is_sandbox)
-
-
-    def __audit_hits(self, is_sandbox):
-        # Gets all assignments that have been accepted but don't have an audit yet
-
-        current_audit_assignment_ids = []
-        closed_audits = []
-
-        for assignmentaudit in AssignmentAudit.objects.all():
-            current_audit_assignment_ids.append(assignmentaudit.assignment_id)
-
-        for assignmentaudit in AssignmentAudit.objects.filter(closed=True):
-            closed_audits.append(assignmentaudit.assignment_id)
-
+            watermark = AuditWatermark.objects.filter(is_sandbox = is_sandbox).first()
+            since = watermark.timestamp if watermark is not None and not options['full'] else None
+            passes.append((is_sandbox, timezone.now(), since))
+
+        workers = options['workers']
+        if workers > 1 and connection.vendor != 'postgresql':
+            # the shards coordinate through advisory locks, and SQLite can't take concurrent writers anyway
+            self.stderr.write(self.style.WARNING('--workers needs PostgreSQL, auditing in one process'))
+            workers = 1
+
+        if workers == 1:
+            for is_sandbox, run_started, since in passes:
+                self.stdout.write(self.style.WARNING('Sandbox mode: %s' % is_sandbox))
+                self.audit_shard(is_sandbox, run_started, since)
+        else:
+            # one task per requester and pass, so a requester with a lot of HIT Types doesn't hold up the rest
+            shards = [(is_sandbox, run_started, since, [requester_id]) for requester_id in Requester.objects.values_list('aws_account', flat = True) for is_sandbox, run_started, since in passes]
+            # the workers are forked, and must not share our database connection
+            connections.close_all()
+            with multiprocessing.Pool(workers, initializer = init_worker) as pool:
+                for output in pool.imap_unordered(run_shard, shards):
+                    self.stdout.write(output, ending = '')
+
+        # only reached if every shard succeeded.
+        # HIT Types are stamped as changed inside the writer's transaction, before it commits, so a change
+        # stamped just before this run started may not have been visible to it: leave a margin for those
+        margin = getattr(settings, 'AUDIT_WATERMARK_MARGIN', timedelta(minutes = 5))
+        for is_sandbox, run_started, since in passes:
+            AuditWatermark.objects.update_or_create(is_sandbox = is_sandbox, defaults = {'timestamp': run_started - margin})
+
+    def audit_shard(self, is_sandbox, run_started, since, requester_ids = None):
+        """
+        Audits the HIT Types of the given requesters (all requesters if None) that changed
+        since `since` (all of them if None), then emails the requesters about new audits.
+        Safe to run alongside other shards, and other runs of the command.
+        """
+        self.__audit_hits(is_sandbox, run_started, since, requester_ids)
+        self.__notify_requesters(is_sandbox, requester_ids)
+
+    def __audit_hits(self, is_sandbox, run_started, since, requester_ids):
+        # Gets all assignments that have been accepted but don't have a closed audit yet
+        closed_audits = AssignmentAudit.objects.filter(closed = True).values('assignment_id')
         auditable = Assignment.objects.filter(status=Assignment.APPROVED).exclude(id__in=closed_audits).distinct()
 
         if is_sandbox:
             auditable = auditable.filter(hit__hit_type__host__contains = 'sandbox')
         else:
             auditable = auditable.exclude(hit__hit_type__host__contains = 'sandbox')
+        if requester_ids is not None:
+            auditable = auditable.filter(hit__hit_type__requester_id__in = requester_ids)
 
         hit_type_query = HITType.objects.filter(hit__assignment__in=auditable).distinct()
+        if since is not None:
+            # only HIT Types with new reports, approvals or freezes since the last run
+            hit_type_query = hit_type_query.filter(changed__gte = since)
+            auditable = auditable.filter(hit__hit_type__changed__gte = since)
+        self.stdout.write('Auditing %d HIT Type%s' % (len(hit_type_query), pluralize(len(hit_type_query))))
+
+        # Take the median report for all assignments in each HIT that needs auditing, from the HITs' summaries
+        hit_type_durations = dict()
+        for hit_type_id, hit_id, median_duration in get_hit_median_durations(auditable):
+            hit_type_durations.setdefault(hit_type_id, []).append(median_duration)
+        hit_type_summaries = dict()
+        for hit_type_id, count, median_duration in HITTypeDurationSummary.objects.filter(hit_type__in = hit_type_query).values_list('hit_type_id', 'count', 'median'):
+            hit_type_summaries[hit_type_id] = (count, median_duration)
 
         for hit_type in hit_type_query:
-            # Get the HITs that need auditing
-            hit_query = HIT.objects.filter(hit_type=hit_type).filter(assignment__in = auditable).distinct()
-
-            hit_durations = list()
-
-            for hit in hit_query:
-                req_id = HITType.objects.get(pk = HIT.objects.get(pk = hit).hit_type_id).requester_id
-                frozen_workers = set(())
-                for freeze_object in RequesterFreeze.objects.filter(requester_id = req_id):
-                    frozen_workers.add(freeze_object.worker_id)
-                duration_query = AssignmentDuration.objects.filter(assignment__hit = hit).exclude(assignment__worker__in=frozen_workers).distinct()
-
-                # Take the median report for all assignments in that HIT
-                if len(duration_query) > 0:
-                    median_duration = median(duration_query.values_list('duration', flat=True))
-                    hit_durations.append(median_duration)
-
-            # now, hit_durations contains the median reported time for each HIT
-            # that has at least one assignment needing an audit.
-            # next step: take the median of the medians across these HITs to
-            # calculate the overall effective time
-            if len(hit_durations) == 0:
-                # nobody reported anything
-                estimated_time = None
-                estimated_rate = None
-            else:
-                estimated_time = median(hit_durations)
-                estimated_rate = Decimal(hit_type.payment / Decimal(estimated_time.total_seconds() / (60*60))).quantize(Decimal('.01'))
-                if estimated_rate == 0:
-                    estimated_rate = Decimal('0.01') # minimum accepted Decimal value, $0.01 per hour
-
-            hit_assignments = auditable.filter(hit__in = hit_query).distinct()
-            for assignment in hit_assignments:
-                # first check if there is already assignmentaudit for assignmentid
-                if assignment.id in current_audit_assignment_ids:
-                    assignmentaudit = AssignmentAudit.objects.get(assignment_id = assignment.id)
-                    if estimated_time != assignmentaudit.estimated_time or estimated_rate != assignmentaudit.estimated_rate:
-                        assignmentaudit.estimated_time = estimated_time
-                        assignmentaudit.estimated_rate = estimated_rate
-                        assignmentaudit.message_sent = None
-                        assignmentaudit.full_clean()
-                        assignmentaudit.save()
+            with transaction.atomic():
+                # another run may be auditing this HIT Type right now; wait for it to commit
+                advisory_lock(HIT_TYPE_LOCK, hit_type.id)
+
+                hit_durations = hit_type_durations.get(hit_type.id, [])
+                hit_type_summary = hit_type_summaries.get(hit_type.id, (0, None))
+                if HITType.objects.filter(id = hit_type.id, changed__gt = run_started).exists():
+                    # it changed after we read the reports, so read them again: otherwise we could
+                    # overwrite a newer estimate that an overlapping run just wrote
+                    hit_durations = [median_duration for hit_type_id, hit_id, median_duration in get_hit_median_durations(auditable.filter(hit__hit_type = hit_type))]
+                    hit_type_summary = (0, None)
+
+                # now, hit_durations contains the median reported time for each HIT
+                # that has at least one assignment needing an audit.
+                # next step: take the median of the medians across these HITs to
+                # calculate the overall effective time
+                if len(hit_durations) == 0:
+                    # nobody reported anything
+                    estimated_time = None
+                    estimated_rate = None
                 else:
-                    audit = AssignmentAudit(assignment = assignment, estimated_time = estimated_time, estimated_rate = estimated_rate)
-                    if audit.is_underpaid():
-                        audit.needsPayment = True;
-                    audit.full_clean()
-                    audit.save()
-                    current_audit_assignment_ids.append(assignment.id)
-
-    def __notify_requesters(self, is_sandbox):
-        audits = AssignmentAudit.objects.filter(message_sent = None)
-        if is_sandbox:
-            audits = audits.filter(assignment__hit__hit_type__host__contains = 'sandbox')
-        else:
-            audits = audits.exclude(assignment__hit__hit_type__host__contains = 'sandbox')
-
-
-        requesters = Requester.objects.filter(hittype__hit__assignment__assignmentaudit__in = audits).distinct()
+                    if hit_type_summary[0] == len(hit_durations):
+                        # every HIT with a report is being audited, so the HIT Type's summary already has the median
+                        estimated_time = hit_type_summary[1]
+                    else:
+                        estimated_time = median(hit_durations)
+                    estimated_rate = Decimal(hit_type.payment / Decimal(estimated_time.total_seconds() / (60*60))).quantize(Decimal('.01'))
+                    if estimated_rate == 0:
+                        estimated_rate = Decimal('0.01') # minimum accepted Decimal value, $0.01 per hour
+
+                hit_assignment_ids = list(auditable.filter(hit__hit_type = hit_type).values_list('id', flat = True).distinct())
+                save_audits(hit_type, hit_assignment_ids, estimated_time, estimated_rate)
+
+    def __notify_requesters(self, is_sandbox, requester_ids):
+        audits = AssignmentAudit.objects.filter(message_sent = None, is_sandbox = is_sandbox)
+        requesters = Requester.objects.filter(aws_account__in = audits.values('requester_id'))
+        if requester_ids is not None:
+            requesters = requesters.filter(aws_account__in = requester_ids)
 
         for requester in requesters:
-            requester_audit = audits.filter(assignment__hit__hit_type__requester = requester).order_by('assignment__hit', 'assignment__hit__hit_type', 'assignment__worker')
-            self.__notify_requester(requester, requester_audit, is_sandbox)
+            with transaction.atomic():
+                # so that overlapping runs don't both email the requester about the same audits
+                advisory_lock(REQUESTER_LOCK, requester.aws_account)
+                requester_audit = audits.filter(requester = requester).order_by('assignment__hit', 'hit_type', 'assignment__worker')
+                if requester_audit.exists():
+                    self.__notify_requester(requester, requester_audit, is_sandbox)
 
     def __notify_requester(self, requester, requester_audit, is_sandbox):
         email = requester.email
         self.stdout.write(email)
-        plain_message = audit_list_message(requester_audit, requester, False, False, is_sandbox)
-        html_message = audit_list_message(requester_audit, requester, False, True, is_sandbox)
+        report = build_audit_report(requester_audit)
+        plain_message = render_audit_report(report, requester, False, False, is_sandbox)
+        html_message = render_audit_report(report, requester, False, True, is_sandbox)
         self.stdout.write(plain_message)
 
         if is_sandbox:
             subject = "Fair Work Sandbox: "
         else:
             subject = "Fair Work: "
-        subject += "Mechanical Turk bonuses pending for $%.2f" % get_underpayment(requester_audit)
+        subject += "Mechanical Turk bonuses pending for $%.2f" % report['total_unpaid']
         send_mail(subject, plain_message, admin_email_address(), [email], fail_silently=False, html_message=html_message)
 
+        # only the audits in the email: more may have come in since we read them
         sent_time = timezone.now()
-        for audit in requester_audit:
-            audit.message_sent = sent_time
-            audit.save()
+        audit_ids = [audit.id for audit in report['audits']]
+        for i in range(0, len(audit_ids), 500):
+            AssignmentAudit.objects.filter(id__in = audit_ids[i:i + 500]).update(message_sent = sent_time, timestamp = sent_time)
+
+
+def init_worker():
+    django.setup()
+    connections.close_all()
+
+def run_shard(shard):
+    """
+    Runs one shard of a --workers run in a pool process, and returns what it printed
+    """
+    is_sandbox, run_started, since, requester_ids = shard
+    output = io.StringIO()
+    command = Command(stdout = output, stderr = output)
+    command.stdout.write(command.style.WARNING('Sandbox mode: %s, requester %s' % (is_sandbox, ', '.join(requester_ids))))
+    command.audit_shard(is_sandbox, run_started, since, requester_ids)
+    return output.getvalue()
 
 
 # Expose these methods publicly
 REQUESTER_GRACE_PERIOD = timedelta(hours = 0) if settings.DEBUG else timedelta(hours = 12)
 
 def audit_list_message(assignments_to_bonus, requester, is_worker, is_html, is_sandbox):
-    total_unpaid = get_underpayment(assignments_to_bonus)
+    return render_audit_report(build_audit_report(assignments_to_bonus), requester, is_worker, is_html, is_sandbox)
+
+def build_audit_report(assignments_to_bonus):
+    """
+    Loads everything an audit list message shows in four queries, however many HIT Types and
+    workers it covers, so the plain text and HTML versions can be rendered from one load.
+    HIT Types and workers are sorted by id.
+    """
+    audits = list(assignments_to_bonus.select_related('assignment__hit__hit_type', 'assignment__worker'))
+
+    reports = defaultdict(list)
+    durations = AssignmentDuration.objects.filter(assignment__assignmentaudit__in = assignments_to_bonus).values_list('assignment__hit__hit_type_id', 'assignment__worker_id', 'duration')
+    for hit_type_id, worker_id, duration in durations:
+        reports[(hit_type_id, worker_id)].append(duration)
+
+    hit_types = dict()
+    for audit in audits:
+        hit_type = audit.assignment.hit.hit_type
+        if hit_type.id not in hit_types:
+            # the audits of a HIT Type share one estimate, so the first one stands for all of them
+            hit_types[hit_type.id] = {'hit_type': hit_type, 'audit': audit, 'audits': [], 'hits': set(), 'workers': set()}
+        hit_types[hit_type.id]['audits'].append(audit)
+        hit_types[hit_type.id]['hits'].add(audit.assignment.hit_id)
+        hit_types[hit_type.id]['workers'].add(audit.assignment.worker_id)
+
+    hit_type_totals = get_underpayments(assignments_to_bonus, 'assignment__hit__hit_type_id')
+    report = {'audits': audits, 'total_unpaid': get_underpayment(assignments_to_bonus), 'hit_types': []}
+    for hit_type_id in sorted(hit_types.keys()):
+        entry = hit_types[hit_type_id]
+        entry['total_unpaid'] = hit_type_totals[hit_type_id]
+        # (worker id, that worker's reports) for every worker, including those who didn't report a time
+        entry['workers'] = [(worker_id, reports[(hit_type_id, worker_id)]) for worker_id in sorted(entry['workers'])]
+        report['hit_types'].append(entry)
+    return report
+
+def render_audit_report(report, requester, is_worker, is_html, is_sandbox):
+    total_unpaid = report['total_unpaid']
     signer = Signer(salt=get_salt())
 
+    message = render_audit_header(is_worker, is_html, is_sandbox)
+
+    message += "<p>" if is_html else ""
+    message += "The total bonus amount is $%.2f. The tasks being bonused:" % total_unpaid
+    message += "</p><ul>" if is_html else "\n\n"
+
+    for entry in report['hit_types']:
+        workers = entry['workers']
+
+        s = "<li>" if is_html else ""
+        s += render_hit_type_summary(entry['hit_type'], entry['audit'], len(entry['hits']), len(workers), len(entry['audits']), entry['total_unpaid'], is_worker)
+        s += "<ul>" if is_html else "\n"
+
+        if not is_worker:
+            for worker_id, durations in workers:
+                if len(durations) > 0:
+                    median_nomicroseconds = str(median(durations)).split(".")[0]
+                    s += "<li>" if is_html else "\t"
+                    s += "Worker %s: " % worker_id
+                    s += "{num_reports:d} report{report_plural:s}, median duration {median_duration:s}. ".format(num_reports=len(durations), report_plural=pluralize(len(durations)), median_duration=median_nomicroseconds)
+                    worker_signed = signer.sign(worker_id)
+                    freeze_url = settings.HOSTNAME + reverse('freeze', kwargs={'requester': requester.aws_account, 'worker_signed': worker_signed})
+
+                    if is_html:
+                        s += "<a href='{freeze_url:s}'>Freeze this worker's payment</a>".format(freeze_url=freeze_url)
+                    else:
+                        s += "Freeze this worker's payment: {freeze_url:s}".format(freeze_url=freeze_url)
+                    s += "</li>" if is_html else "\n"
+                # maybe else say something like this worker is probably frozen
+
+        s += "</li>" if is_html else "\n\n"
+        message += s
+    return message
+
+def render_audit_header(is_worker, is_html, is_sandbox):
     message = ""
 
     if is_sandbox:
@@ -175,79 +295,146 @@ def audit_list_message(assignments_to_bonus, requester, is_worker, is_html, is_s
         message += "<p>" if is_html else ""
         message += "Bonuses will be sent in %d hours: %s. You can review the pending bonuses below and freeze bonuses if something looks unusual. Please remember to trust the workers' estimates, and only freeze bonuses if absolutely needed." % (REQUESTER_GRACE_PERIOD.total_seconds() / (60*60), timezone.localtime(timezone.now() + REQUESTER_GRACE_PERIOD).strftime("%B %d at %-I:%M%p %Z"))
         message += "</p>" if is_html else "\n\n"
-
-    message += "<p>" if is_html else ""
-    message += "The total bonus amount is $%.2f. The tasks being bonused:" % total_unpaid
-    message += "</p><ul>" if is_html else "\n\n"
-
-    hit_types = HITType.objects.filter(hit__assignment__assignmentaudit__in = assignments_to_bonus).distinct()
-
-    for hit_type in hit_types:
-        hittype_assignments = assignments_to_bonus.filter(assignment__hit__hit_type = hit_type)
-        hits = HIT.objects.filter(assignment__assignmentaudit__in = hittype_assignments).distinct()
-        workers = Worker.objects.filter(assignment__assignmentaudit__in = hittype_assignments).distinct()
-
-        s = "<li>" if is_html else ""
-
-        underpayment = hittype_assignments[0].get_underpayment()
-        time_nomicroseconds = str(hittype_assignments[0].estimated_time).split(".")[0]
-        if underpayment is None:
-            summary = "HIT Type {hittype:s} originally paid ${payment:.2f} per task. No workers reported time elapsed for this HIT, so effective rate cannot be estimated. No bonuses will be sent.".format(hittype = hit_type.id, payment = hit_type.payment)
-        elif underpayment <= Decimal('0.00'):
-            summary = "HIT Type {hittype:s} originally paid ${payment:.2f} per task. Median estimated time across {num_workers:d} worker{workers_plural:s} was {estimated:s}, for an estimated rate of ${paymentrate:.2f}/hr. No bonus necessary.".format(hittype = hit_type.id, payment = hit_type.payment, estimated = time_nomicroseconds, paymentrate = hittype_assignments[0].estimated_rate, num_workers=len(workers), workers_plural=pluralize(len(workers)))
-        else:
-            paymentrevised = hit_type.payment + hittype_assignments[0].get_underpayment()
-            bonus = underpayment.quantize(Decimal('1.000')).normalize() if underpayment >= Decimal(0.01) else underpayment.quantize(Decimal('1.000'))
-            paymentrevised = paymentrevised.quantize(Decimal('1.000')).normalize() if paymentrevised >= Decimal(0.01) else paymentrevised.quantize(Decimal('1.000'))
-            if is_worker:
-                summary = "HIT Type {hittype:s} originally paid ${payment:.2f} per task. Median estimated time was {estimated:s}, for an estimated rate of ${paymentrate:.2f}/hr. Bonus ${bonus:f} for each assignment in HIT{hits_plural:s} to bring the payment to a suggested ${paymentrevised:f} each.".format(hittype = hit_type.id, payment = hit_type.payment, estimated = time_nomicroseconds, paymentrate = hittype_assignments[0].estimated_rate, bonus = bonus, hits_plural=pluralize(len(hits)), paymentrevised = paymentrevised)
-            else: 
-                summary = "HIT Type {hittype:s} originally paid ${payment:.2f} per task. Median estimated time across {num_workers:d} worker{workers_plural:s} was {estimated:s}, for an estimated rate of ${paymentrate:.2f}/hr. Bonus ${bonus:f} for each of {num_assignments:d} assignment{assignment_plural:s} in {num_hits:d} HIT{hits_plural:s} to bring the payment to a suggested ${paymentrevised:f} each. Total: ${totalbonus:.2f} bonus.".format(hittype = hit_type.id, payment = hit_type.payment, estimated = time_nomicroseconds, paymentrate = hittype_assignments[0].estimated_rate, bonus = bonus, num_assignments = len(hittype_assignments), assignment_plural=pluralize(len(hittype_assignments)), num_hits=len(hits), hits_plural=pluralize(len(hits)), num_workers=len(workers), workers_plural=pluralize(len(workers)), paymentrevised = paymentrevised, totalbonus = get_underpayment(hittype_assignments))
-        s += summary
-        s += "<ul>" if is_html else "\n"
-
-        # anon_worker_id = 1
-
-        if not is_worker:
-            for worker in workers:
-                duration_query = AssignmentDuration.objects.filter(assignment__worker = worker).filter(assignment__hit__hit_type = hit_type).filter(assignment__assignmentaudit__in = assignments_to_bonus)
-                if len(duration_query) > 0:
-                    median_duration = median(duration_query.values_list('duration', flat=True))
-                    median_nomicroseconds = str(median_duration).split(".")[0]
-                    s += "<li>" if is_html else "\t"
-                    # if is_worker:
-                    #     s += "Worker " + str(anon_worker_id) + ": "
-                    #     anon_worker_id += 1
-                    # else:
-                    s += "Worker %s: " % worker.id
-                    s += "{num_reports:d} report{report_plural:s}, median duration {median_duration:s}. ".format(num_reports=len(duration_query), report_plural=pluralize(len(duration_query)), median_duration=median_nomicroseconds)
-                    if not is_worker:
-                        worker_signed = signer.sign(worker.id)
-                        freeze_url = settings.HOSTNAME + reverse('freeze', kwargs={'requester': requester.aws_account, 'worker_signed': worker_signed})
-
-                        if is_html:
-                            s += "<a href='{freeze_url:s}'>Freeze this worker's payment</a>".format(freeze_url=freeze_url)
-                        else:
-                            s += "Freeze this worker's payment: {freeze_url:s}".format(freeze_url=freeze_url)
-                    s += "</li>" if is_html else "\n"
-                # maybe else say something like this worker is probably frozen
-
-        s += "</li>" if is_html else "\n\n"
-        message += s
     return message
 
-def is_worker_frozen(worker):
-    for freeze_object in RequesterFreeze.objects.all():
-        if freeze_object.worker == worker:
-            return True;
-    return False;
+def render_hit_type_summary(hit_type, first_audit, num_hits, num_workers, num_assignments, total_unpaid, is_worker):
+    """
+    The sentence about one HIT Type in an audit list message. first_audit stands for the
+    estimate that all of the HIT Type's audits share.
+    """
+    underpayment = first_audit.get_underpayment()
+    time_nomicroseconds = str(first_audit.estimated_time).split(".")[0]
+    if underpayment is None:
+        summary = "HIT Type {hittype:s} originally paid ${payment:.2f} per task. No workers reported time elapsed for this HIT, so effective rate cannot be estimated. No bonuses will be sent.".format(hittype = hit_type.id, payment = hit_type.payment)
+    elif underpayment <= Decimal('0.00'):
+        summary = "HIT Type {hittype:s} originally paid ${payment:.2f} per task. Median estimated time across {num_workers:d} worker{workers_plural:s} was {estimated:s}, for an estimated rate of ${paymentrate:.2f}/hr. No bonus necessary.".format(hittype = hit_type.id, payment = hit_type.payment, estimated = time_nomicroseconds, paymentrate = first_audit.estimated_rate, num_workers=num_workers, workers_plural=pluralize(num_workers))
+    else:
+        paymentrevised = hit_type.payment + underpayment
+        bonus = underpayment.quantize(Decimal('1.000')).normalize() if underpayment >= Decimal(0.01) else underpayment.quantize(Decimal('1.000'))
+        paymentrevised = paymentrevised.quantize(Decimal('1.000')).normalize() if paymentrevised >= Decimal(0.01) else paymentrevised.quantize(Decimal('1.000'))
+        if is_worker:
+            summary = "HIT Type {hittype:s} originally paid ${payment:.2f} per task. Median estimated time was {estimated:s}, for an estimated rate of ${paymentrate:.2f}/hr. Bonus ${bonus:f} for each assignment in HIT{hits_plural:s} to bring the payment to a suggested ${paymentrevised:f} each.".format(hittype = hit_type.id, payment = hit_type.payment, estimated = time_nomicroseconds, paymentrate = first_audit.estimated_rate, bonus = bonus, hits_plural=pluralize(num_hits), paymentrevised = paymentrevised)
+        else: 
+            summary = "HIT Type {hittype:s} originally paid ${payment:.2f} per task. Median estimated time across {num_workers:d} worker{workers_plural:s} was {estimated:s}, for an estimated rate of ${paymentrate:.2f}/hr. Bonus ${bonus:f} for each of {num_assignments:d} assignment{assignment_plural:s} in {num_hits:d} HIT{hits_plural:s} to bring the payment to a suggested ${paymentrevised:f} each. Total: ${totalbonus:.2f} bonus.".format(hittype = hit_type.id, payment = hit_type.payment, estimated = time_nomicroseconds, paymentrate = first_audit.estimated_rate, bonus = bonus, num_assignments = num_assignments, assignment_plural=pluralize(num_assignments), num_hits=num_hits, hits_plural=pluralize(num_hits), num_workers=num_workers, workers_plural=pluralize(num_workers), paymentrevised = paymentrevised, totalbonus = total_unpaid)
+    return summary
+
+def render_worker_message(total_unpaid, fragments, is_sandbox):
+    """
+    The worker's audit list message (the bonus reason), put together from the HIT Type summaries
+    in fragments, each rendered with render_worker_fragment. Same text as audit_list_message.
+    """
+    message = render_audit_header(True, False, is_sandbox)
+    message += "The total bonus amount is $%.2f. The tasks being bonused:\n\n" % total_unpaid
+    return message + "".join(fragments)
+
+def render_worker_fragment(hit_type, first_audit, num_hits):
+    # a worker's message only covers that one worker
+    return render_hit_type_summary(hit_type, first_audit, num_hits, 1, None, None, True) + "\n" + "\n\n"
+
+def get_hit_median_durations(auditable, chunk_size = 500):
+    """
+    Yields (hit_type_id, hit_id, median duration) for every HIT that has an assignment in
+    auditable and at least one time report, leaving out reports from workers that the
+    HIT's requester has frozen. Read from the HITs' duration summaries in one query.
+
+    Reports written without signals (e.g., with bulk_create) leave their HIT without a summary.
+    Those HITs' summaries are built from the reports first, rather than leaving the HITs out.
+    """
+    hits = HIT.objects.filter(assignment__in = auditable)
+    unsummarized = list(hits.filter(hitdurationsummary__isnull = True, assignment__assignmentduration__isnull = False).values_list('id', flat = True).distinct())
+    for i in range(0, len(unsummarized), chunk_size):
+        rebuild_summaries(HIT.objects.filter(id__in = unsummarized[i:i + chunk_size]))
+
+    summaries = HITDurationSummary.objects.filter(hit__in = hits, count__gt = 0)
+    yield from summaries.values_list('hit__hit_type_id', 'hit_id', 'median').iterator()
+
+def save_audits(hit_type, assignment_ids, estimated_time, estimated_rate, chunk_size = 500):
+    """
+    Creates or updates the audits of a HIT Type's assignments, which all share one estimate.
+    Existing audits are looked up in one query per chunk rather than one per assignment,
+    and everything is written in one transaction.
+    """
+    # every audit gets the same estimate, so validating one validates them all
+    template = AssignmentAudit(estimated_time = estimated_time, estimated_rate = estimated_rate)
+    template.set_hit_type(hit_type)
+    template.clean_fields(exclude = ['assignment'])
+    template.clean()
+    needs_payment = template.is_underpaid()
+    frozen_workers = freezes.get_frozen_workers(hit_type.requester_id)
+
+    with transaction.atomic():
+        for i in range(0, len(assignment_ids), chunk_size):
+            chunk = assignment_ids[i:i + chunk_size]
+            existing = dict()
+            for assignment_id, audit_time, audit_rate in AssignmentAudit.objects.filter(assignment_id__in = chunk).values_list('assignment_id', 'estimated_time', 'estimated_rate'):
+                existing[assignment_id] = (audit_time, audit_rate)
+
+            # only audits whose estimate moved are reset, so the requester hears about the change
+            changed = [assignment_id for assignment_id, estimate in existing.items() if estimate != (estimated_time, estimated_rate)]
+            if len(changed) > 0:
+                AssignmentAudit.objects.filter(assignment_id__in = changed).update(estimated_time = estimated_time, estimated_rate = estimated_rate, message_sent = None, timestamp = timezone.now(),
+                    payment = template.payment, requester_id = template.requester_id, hit_type_id = template.hit_type_id, is_sandbox = template.is_sandbox)
+                # a bonus queued under the old estimate must not go out; payaudits queues new ones after the grace period.
+                # One that MTurk may already have paid stays, so its audits aren't paid twice, until it's been reconciled.
+                BonusPayment.objects.filter(status__in = BonusPayment.OPEN_STATUSES, may_be_paid = False, audits__assignment_id__in = changed).update(status = BonusPayment.CANCELLED, next_attempt_at = None)
+
+            # new audits of workers the requester already froze start out frozen, like the ones the freeze itself marked
+            frozen = set()
+            if len(frozen_workers) > 0:
+                frozen = set(Assignment.objects.filter(id__in = chunk, worker_id__in = frozen_workers).values_list('id', flat = True))
+
+            new_audits = [AssignmentAudit(assignment_id = assignment_id, estimated_time = estimated_time, estimated_rate = estimated_rate, needsPayment = needs_payment, frozen = assignment_id in frozen,
+                payment = template.payment, requester_id = template.requester_id, hit_type_id = template.hit_type_id, is_sandbox = template.is_sandbox) for assignment_id in chunk if assignment_id not in existing]
+            AssignmentAudit.objects.bulk_create(new_audits)
+
+# namespaces for advisory_lock
+HIT_TYPE_LOCK = 1
+REQUESTER_LOCK = 2
+
+def advisory_lock(namespace, key):
+    """
+    Takes a PostgreSQL advisory lock on key, held until the current transaction ends.
+    Other databases have no advisory locks, and this does nothing there.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s))', [namespace, key])
 
 def get_underpayment(assignments_to_bonus):
-    total_unpaid = Decimal('0.00')
-    for unpaid_task in assignments_to_bonus:
-        underpayment = unpaid_task.get_underpayment()
-        if underpayment is not None:
-            total_unpaid += underpayment
+    """
+    The total bonus owed on a queryset of audits, summed by the database in one query
+    """
+    total_unpaid = assignments_to_bonus.aggregate(total_unpaid = Sum(underpayment_expression()))['total_unpaid']
+    return round_up_to_cent(total_unpaid)
+
+def get_underpayments(assignments_to_bonus, field):
+    """
+    Returns {value of field: total bonus owed} for a queryset of audits, e.g., per worker with
+    field='assignment__worker_id'. One query, however many groups there are.
+    """
+    totals = assignments_to_bonus.order_by().values(field).annotate(total_unpaid = Sum(underpayment_expression()))
+    return dict((total[field], round_up_to_cent(total['total_unpaid'])) for total in totals)
+
+def underpayment_expression():
+    """
+    AssignmentAudit.get_underpayment() as a database expression: NULL when the effective
+    rate is unknown, 0 when the HIT Type met the minimum wage
+    """
+    # the decimal point matters: SQLite stores whole-number decimals as integers, and would divide them as integers
+    minimum_wage = Value(Decimal(settings.MINIMUM_WAGE_PER_HOUR).quantize(Decimal('0.000001')), output_field = DecimalField())
+    return Case(
+        When(estimated_time__isnull = True, then = Value(None)),
+        When(estimated_rate__lt = minimum_wage, then = F('payment') * (minimum_wage / F('estimated_rate') - Value(1))),
+        When(estimated_rate__isnull = False, then = Value(Decimal('0.00'))),
+        output_field = DecimalField(max_digits = 20, decimal_places = 6)
+    )
+
+def round_up_to_cent(total_unpaid):
+    if total_unpaid is None:
+        total_unpaid = Decimal('0.00')
+    # drop the noise that the database's division leaves in the last digits, so an exact
+    # amount like $0.60 isn't rounded up to $0.61
+    total_unpaid = Decimal(total_unpaid).quantize(Decimal('0.000001'))
     # don't shortchange workers --- round up to the nearest cent
     total_unpaid = math.ceil(total_unpaid * Decimal('100.0')) / Decimal('100.0')
     return total_unpaid
@@ -0,0 +1,92 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ImproperlyConfigured
+
+import json
+
+from auditor.models import Assignment
+from auditor.queues import get_notification_queue
+from auditor.management.commands.pullnotifications import save_status_transitions
+
+"""
+Applies MTurk assignment notifications (AssignmentSubmitted, AssignmentApproved, etc.)
+from a queue as they arrive, instead of polling every open assignment. Point the HIT
+Type's notification at the queue with UpdateNotificationSettings. pullnotifications
+can then run much less often, to catch anything the notifications missed.
+"""
+
+# The status each event moves an assignment to, and the statuses it may move it from.
+# Events can arrive out of order, so an event never moves an assignment backwards.
+EVENT_TRANSITIONS = {
+    'AssignmentSubmitted': (Assignment.SUBMITTED, [Assignment.OPEN, Assignment.EXPIRED]),
+    'AssignmentApproved': (Assignment.APPROVED, [Assignment.OPEN, Assignment.SUBMITTED, Assignment.EXPIRED]),
+    'AssignmentRejected': (Assignment.REJECTED, [Assignment.OPEN, Assignment.SUBMITTED, Assignment.EXPIRED]),
+    # pullnotifications marks returned assignments as expired once they time out; the notification lets us do it right away
+    'AssignmentReturned': (Assignment.EXPIRED, [Assignment.OPEN]),
+    'AssignmentAbandoned': (Assignment.EXPIRED, [Assignment.OPEN]),
+}
+
+class Command(BaseCommand):
+    help = 'Reads MTurk assignment notifications from a queue and updates assignment statuses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of messages to apply in each database transaction')
+        parser.add_argument('--wait', type=int, default=20, help='Seconds to wait for new messages on each receive')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty instead of running forever')
+
+    def handle(self, *args, **options):
+        try:
+            queue = get_notification_queue()
+        except ImproperlyConfigured as e:
+            raise CommandError(e)
+
+        while True:
+            messages = self.__receive_batch(queue, options['batch_size'], options['wait'])
+            if len(messages) == 0:
+                if options['once']:
+                    return
+                continue
+
+            events = []
+            for handle, body in messages:
+                try:
+                    events.extend(json.loads(body)['Events'])
+                except (ValueError, KeyError, TypeError) as e:
+                    # a message we can't read will never get better, so drop it rather than retrying forever
+                    self.stderr.write(self.style.ERROR('Skipping unreadable notification %s: %s' % (handle, e)))
+
+            counts = save_status_transitions(get_transitions(events))
+            # only acknowledge the messages once their updates are committed
+            queue.delete([handle for handle, body in messages])
+
+            self.stdout.write('%d notification%s, %d event%s' % (len(messages), '' if len(messages) == 1 else 's', len(events), '' if len(events) == 1 else 's'))
+            for status, count in sorted(counts.items()):
+                self.stdout.write(self.style.SUCCESS('%d assignment%s moved to %s' % (count, '' if count == 1 else 's', dict(Assignment.STATUS_CHOICES)[status])))
+
+    def __receive_batch(self, queue, batch_size, wait):
+        messages = []
+        while len(messages) < batch_size:
+            # only block while the batch is empty; after that, take whatever is ready
+            received = queue.receive(batch_size - len(messages), wait if len(messages) == 0 else 0)
+            if len(received) == 0:
+                break
+            messages.extend(received)
+        return messages
+
+
+def get_transitions(events):
+    """
+    Returns {assignment id: new status} for the events that apply to assignments we track
+    """
+    # if several events arrive for one assignment, the most recent one wins
+    latest = dict()
+    for event in sorted(events, key = lambda event: event.get('EventTimestamp', '')):
+        if event.get('EventType') in EVENT_TRANSITIONS and 'AssignmentId' in event:
+            latest[event['AssignmentId']] = event['EventType']
+
+    transitions = dict()
+    current_statuses = Assignment.objects.filter(id__in = list(latest.keys())).values_list('id', 'status')
+    for assignment_id, current_status in current_statuses:
+        new_status, from_statuses = EVENT_TRANSITIONS[latest[assignment_id]]
+        if current_status in from_statuses:
+            transitions[assignment_id] = new_status
+    return transitions
@@ -0,0 +1,283 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db.models import Q, Sum, F
+from django.utils import timezone
+
+import decimal
+from decimal import Decimal
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from queue import Queue
+
+from botocore.exceptions import ClientError
+
+from auditor.models import AssignmentAudit, BonusPayment
+from auditor.mturk import get_mturk_client, is_throttling_error, CONNECTION_ERRORS, MTURK_ERRORS
+from auditor.freezes import get_frozen_workers
+from auditor.management.commands import auditpayments
+
+"""
+Sends the bonuses that payaudits queued as BonusPayments. Only bonuses that are due are
+sent, so this can run as often as you like, and a requester who is out of funds costs one
+attempt per bonus per retry interval rather than one per run:
+- Accepted (or already sent under the same token): the bonus is paid and its audits are closed.
+- Insufficient funds: retried with exponential backoff until the requester deposits more.
+  The worker and the requester are told once, when the bonus first runs out of funds.
+  Each requester's balance is looked up once per run, and bonuses that won't fit in it are
+  not sent at all.
+- Anything else: retried with backoff. Errors that MTurk returns for the request itself
+  give up after BONUS_MAX_ATTEMPTS attempts and leave the bonus failed, for an admin to look at.
+Bonuses for workers whose requester froze them after they were queued are cancelled.
+
+A bonus is marked may_be_paid from just before it's sent until MTurk's answer shows whether
+it was paid. If this stops partway through, or MTurk's answer is unclear, the mark stays, and
+reconcilebonuses (or sending the bonus again, under the same token) settles it.
+"""
+
+class Command(BaseCommand):
+    help = 'Sends the queued bonuses that are due'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'BONUS_WORKERS', 1), help='Number of threads sending bonuses concurrently. Bonuses are queued by requester, so each AWS account is paid by one thread at a time.')
+
+    def handle(self, *args, **options):
+        self.now = timezone.now()
+        cancel_stale_bonuses()
+
+        due = BonusPayment.objects.filter(status__in = BonusPayment.OPEN_STATUSES).filter(Q(next_attempt_at__isnull = True) | Q(next_attempt_at__lte = self.now))
+        due = due.select_related('requester').order_by('-is_sandbox', 'requester_id', 'id')
+
+        # Everything that touches the database happens on the main thread. The bonuses for each
+        # requester and host form a queue that one worker thread sends in order, so sandbox and
+        # production queues can go out side by side.
+        queues = []
+        for (requester_id, is_sandbox), bonuses in itertools.groupby(due, key = lambda bonus: (bonus.requester_id, bonus.is_sandbox)):
+            bonuses = list(bonuses)
+            frozen_workers = get_frozen_workers(requester_id)
+            cancel_bonuses([bonus.id for bonus in bonuses if bonus.worker_id in frozen_workers])
+            bonuses = [bonus for bonus in bonuses if bonus.worker_id not in frozen_workers]
+            if len(bonuses) > 0:
+                requester = bonuses[0].requester
+                queues.append({'requester': requester, 'is_sandbox': is_sandbox, 'mturk_client': get_mturk_client(requester, is_sandbox), 'bonuses': bonuses})
+
+        # from here on, MTurk may accept any of these without our hearing about it
+        mark_may_be_paid([bonus.id for queue in queues for bonus in queue['bonuses']])
+
+        self.counts = dict((status, 0) for status, name in BonusPayment.STATUS_CHOICES)
+        results = Queue()
+        with ThreadPoolExecutor(max_workers = max(1, options['workers'])) as executor:
+            futures = [executor.submit(self.__send_bonuses, queue, results) for queue in queues]
+            self.__collect_results(results, len(queues))
+            for future in futures:
+                future.result() # raises whatever stopped a queue, now that everything it sent is recorded
+
+        self.stdout.write(self.style.SUCCESS('%d bonuses paid, %d waiting for funds, %d to retry, %d failed' % (self.counts[BonusPayment.PAID], self.counts[BonusPayment.UNFUNDED], self.counts[BonusPayment.PENDING], self.counts[BonusPayment.FAILED])))
+
+    def __send_bonuses(self, queue, results):
+        """
+        Sends a requester's bonuses, one after another. Runs on a worker thread, so it must not
+        touch the database: as soon as MTurk answers, it puts (queue, RESULT, (bonus, new status, error,
+        whether MTurk may have paid it anyway)) on results for the main thread to record, and (queue, LOG, (is error, line)) for each line
+        to log. (queue, DONE, None) comes last, even if sending stopped with an exception.
+
+        The account balance is looked up once, and bonuses are sent in order as long as they (and
+        MTurk's fee) fit in what is left of it. Those that don't are not sent, since they would only fail.
+        """
+        def record(bonus, status, error, may_be_paid = False):
+            results.put((queue, RESULT, (bonus, status, error, may_be_paid)))
+        def log(is_error, line):
+            results.put((queue, LOG, (is_error, line)))
+
+        try:
+            self.__send_queue(queue, record, log)
+        finally:
+            results.put((queue, DONE, None))
+
+    def __send_queue(self, queue, record, log):
+        mturk_client = queue['mturk_client']
+        unfunded_workers = []
+        budget = self.__get_balance(mturk_client, queue['requester'], log) # None if we couldn't find out
+        for bonus in queue['bonuses']:
+            # the main thread updates bonus.status once it records a result, so decide on the status it was queued with
+            was_unfunded = bonus.status == BonusPayment.UNFUNDED
+            cost = bonus_cost(bonus.amount)
+            if budget is not None and cost > budget:
+                log(True, "Requester does not have enough funds for %s's bonus of $%.2f." % (bonus.worker_id, bonus.amount))
+                record(bonus, BonusPayment.UNFUNDED, 'Not sent: $%.2f left of the account balance' % budget)
+                if not was_unfunded:
+                    unfunded_workers.append(bonus.worker_id)
+                continue
+
+            try:
+                mturk_client.send_bonus(WorkerId = bonus.worker_id, BonusAmount = '%.2f' % (bonus.amount), AssignmentId = bonus.assignment_id, Reason = bonus.reason, UniqueRequestToken = bonus.token)
+                record(bonus, BonusPayment.PAID, '')
+                if budget is not None:
+                    budget -= cost
+            except mturk_client.exceptions.RequestError as e:
+                message = e.response['Error']['Message']
+                if message.startswith("This Requester has insufficient funds in their account to complete this transaction."):
+                    log(True, "Requester does not have enough funds for %s's bonus of $%.2f." % (bonus.worker_id, bonus.amount))
+                    # whatever the balance was, it's now less than this bonus costs
+                    budget = cost - Decimal('0.01') if budget is None else min(budget, cost - Decimal('0.01'))
+                    record(bonus, BonusPayment.UNFUNDED, message)
+                    if not was_unfunded:
+                        unfunded_workers.append(bonus.worker_id)
+                elif message.startswith("The idempotency token"): # has already been processed
+                    log(True, "Identical bonus has already been paid on this task. Skipping.")
+                    # They already paid it, mark it as done
+                    record(bonus, BonusPayment.PAID, '')
+                else:
+                    log(True, str(e))
+                    record(bonus, BonusPayment.FAILED, message)
+            except ClientError as e:
+                # e.g., still throttled after retrying, or MTurk failed partway through, in which case it may have paid it
+                log(True, str(e))
+                record(bonus, BonusPayment.PENDING, str(e), not is_throttling_error(e))
+            except CONNECTION_ERRORS as e:
+                # no answer, even after retrying: MTurk may have paid it before the connection dropped
+                log(True, str(e))
+                record(bonus, BonusPayment.PENDING, str(e), True)
+
+        self.__notify_insufficient_funds_workers(mturk_client, unfunded_workers, log)
+
+    def __get_balance(self, mturk_client, requester, log):
+        try:
+            balance = Decimal(mturk_client.get_account_balance()['AvailableBalance'])
+        except MTURK_ERRORS as e:
+            log(True, 'Could not look up the balance of %s, sending bonuses anyway: %s' % (requester.aws_account, e))
+            return None
+        log(False, 'Balance of %s: $%.2f' % (requester.aws_account, balance))
+        return balance
+
+    def __collect_results(self, results, num_queues):
+        """
+        Output and database writes happen here, on the main thread, as results come in. Paid bonuses
+        are recorded a few at a time, whenever no other result is waiting, so if the command stops
+        partway through, bonuses MTurk accepted are not left to be sent again.
+        """
+        max_attempts = getattr(settings, 'BONUS_MAX_ATTEMPTS', 10)
+        paid_ids = []
+        newly_unfunded = set() # (requester, is_sandbox) of the queues with bonuses that just ran out of funds
+        while num_queues > 0:
+            queue, kind, item = results.get()
+            if kind == LOG:
+                is_error, line = item
+                if is_error:
+                    self.stderr.write(self.style.ERROR(line))
+                else:
+                    self.stdout.write(line)
+            elif kind == RESULT:
+                bonus, status, error, may_be_paid = item
+                if status == BonusPayment.PAID:
+                    paid_ids.append(bonus.id)
+                    self.counts[status] += 1
+                else:
+                    if status == BonusPayment.UNFUNDED and bonus.status != BonusPayment.UNFUNDED:
+                        newly_unfunded.add((bonus.requester_id, bonus.is_sandbox))
+
+                    bonus.attempts += 1
+                    bonus.last_error = error
+                    bonus.may_be_paid = may_be_paid
+                    if status == BonusPayment.FAILED and bonus.attempts < max_attempts:
+                        status = BonusPayment.PENDING # MTurk may just be having trouble; give it a few more tries
+                    bonus.status = status
+                    bonus.next_attempt_at = self.now + get_retry_interval(bonus.attempts) if status in BonusPayment.OPEN_STATUSES else None
+                    bonus.save(update_fields = ['status', 'attempts', 'last_error', 'next_attempt_at', 'may_be_paid', 'timestamp'])
+                    self.counts[status] += 1
+            elif kind == DONE:
+                num_queues -= 1
+                # the requester hears about it once, when bonuses first run out of funds, and again only if more do
+                if (queue['requester'].aws_account, queue['is_sandbox']) in newly_unfunded:
+                    total_underpaid = BonusPayment.objects.filter(requester = queue['requester'], is_sandbox = queue['is_sandbox'], status = BonusPayment.UNFUNDED).aggregate(total = Sum('amount'))['total']
+                    self.__notify_insufficient_funds_requester(queue['requester'], total_underpaid)
+
+            if len(paid_ids) >= MARK_PAID_BATCH_SIZE or (len(paid_ids) > 0 and results.empty()):
+                mark_paid(paid_ids)
+                paid_ids = []
+        mark_paid(paid_ids)
+
+    def __notify_insufficient_funds_workers(self, mturk_client, worker_ids, log):
+        """
+        Tells the workers to tell the requester to deposit more money, 100 workers per call.
+        Runs on a worker thread, with the requester's queue.
+        """
+
+        subject = "Fair Work bonus pending, but requester out of funds — please notify requester"
+
+        message = """This is an automated message from the Fair Work script: this requester is trying to bonus you, but they don't have enough funds in their account to send the bonus. Please reply and let them know that they need to deposit more funds.
+This requester is using the Fair Work script to ensure pay rates reach a minimum wage of $%.2f/hr. Fair Work does this by asking for completion times and then auto-bonusing workers to meet the desired hourly wage. Based on worker time reports, your tasks have been underpaid. We are bonusing you to bring you back up to $%.2f/hr.
+We will try to send the bonus again periodically, so you will get paid after they deposit more funds.
+        """ % (settings.MINIMUM_WAGE_PER_HOUR, settings.MINIMUM_WAGE_PER_HOUR)
+
+        for i in range(0, len(worker_ids), NOTIFY_WORKERS_LIMIT):
+            try:
+                response = mturk_client.notify_workers(Subject = subject, MessageText = message, WorkerIds = worker_ids[i:i + NOTIFY_WORKERS_LIMIT])
+                for failure in response.get('NotifyWorkersFailureStatuses', []):
+                    log(True, 'Could not notify %s: %s' % (failure['WorkerId'], failure['NotifyWorkersFailureMessage']))
+
+            except MTURK_ERRORS as e:
+                log(True, str(e))
+
+    def __notify_insufficient_funds_requester(self, requester, total_underpaid):
+        total_deposit = total_underpaid * (1 + BONUS_FEE_RATE)
+        subject = "Error: Fair Work bonuses are pending but you are out of funds. Please deposit $%.2f." % total_deposit
+        message = """This is an automated message from the Fair Work script: you have underpaid workers and need to bonus them, but you don't have enough funds in your account to send the bonus. You need to send bonuses totaling $%.2f, but with Mechanical Turk's fee, you need to deposit $%.2f to have enough funds to send those bonuses. Please deposit more funds, and we will automatically retry in roughly 24 hours.
+We are sending you this note because you are using the Fair Work script to ensure Mechanical Turk pay rates reach a minimum wage of $%.2f/hr. Fair Work does this by asking for completion times and then auto-bonusing workers to meet the desired hourly wage. Based on worker time reports, your tasks have been underpaid.
+        """ % (total_underpaid, total_deposit, settings.MINIMUM_WAGE_PER_HOUR)
+
+        send_mail(subject, message, auditpayments.admin_email_address(), [requester.email], fail_silently=False)
+        self.stdout.write(message)
+
+BONUS_FEE_RATE = Decimal('0.20') # AMT bonus fee rate
+NOTIFY_WORKERS_LIMIT = 100 # most WorkerIds that NotifyWorkers takes at once
+MARK_PAID_BATCH_SIZE = 20 # most paid bonuses recorded at once while others are still being sent
+
+# what __send_bonuses puts on the results queue
+RESULT = 'result'
+LOG = 'log'
+DONE = 'done'
+
+def bonus_cost(amount):
+    # what sending the bonus takes from the requester's balance: MTurk's fee is at least a cent
+    return amount + max(Decimal('0.01'), (amount * BONUS_FEE_RATE).quantize(Decimal('0.01'), rounding = decimal.ROUND_HALF_UP))
+
+def get_retry_interval(attempts):
+    """
+    Doubles the wait after every failed attempt, from BONUS_RETRY_INTERVAL up to BONUS_MAX_RETRY_INTERVAL
+    """
+    base_interval = getattr(settings, 'BONUS_RETRY_INTERVAL', timedelta(hours = 1))
+    max_interval = getattr(settings, 'BONUS_MAX_RETRY_INTERVAL', timedelta(days = 1))
+    return min(base_interval * (2 ** min(attempts - 1, 20)), max_interval)
+
+def mark_paid(bonus_ids, chunk_size = 500):
+    """
+    Marks bonuses paid and closes their audits, a chunk per query, each chunk committed on its own
+    """
+    now = timezone.now()
+    for i in range(0, len(bonus_ids), chunk_size):
+        chunk = bonus_ids[i:i + chunk_size]
+        BonusPayment.objects.filter(id__in = chunk).update(status = BonusPayment.PAID, attempts = F('attempts') + 1, last_error = '', next_attempt_at = None, may_be_paid = False, timestamp = now)
+        AssignmentAudit.objects.filter(bonus_id__in = chunk).update(closed = True, timestamp = now)
+
+def mark_may_be_paid(bonus_ids, chunk_size = 500):
+    for i in range(0, len(bonus_ids), chunk_size):
+        BonusPayment.objects.filter(id__in = bonus_ids[i:i + chunk_size]).update(may_be_paid = True, timestamp = timezone.now())
+
+def cancel_bonuses(bonus_ids, chunk_size = 500):
+    """
+    Cancels bonuses, except those that MTurk may already have paid: cancelling one of those
+    could let its audits be paid again under a new bonus
+    """
+    for i in range(0, len(bonus_ids), chunk_size):
+        BonusPayment.objects.filter(id__in = bonus_ids[i:i + chunk_size], may_be_paid = False).update(status = BonusPayment.CANCELLED, next_attempt_at = None, timestamp = timezone.now())
+
+def cancel_stale_bonuses():
+    """
+    Cancels queued bonuses that no longer pay any open audit: their audits were re-audited
+    (and wait for the requester again) or moved to a new bonus with a different amount.
+    Bonuses that may have been paid are left for reconcilebonuses.
+    """
+    stale = BonusPayment.objects.filter(status__in = BonusPayment.OPEN_STATUSES, may_be_paid = False).exclude(audits__closed = False)
+    cancel_bonuses(list(stale.values_list('id', flat = True)))
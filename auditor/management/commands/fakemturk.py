@@ -0,0 +1,122 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from datetime import timedelta
+from decimal import Decimal
+import random
+
+from auditor.models import HITType, HIT, Worker, Assignment, AssignmentDuration, Requester
+from auditor.fakemturk import FakeMTurk, STATUSES, make_server
+from auditor.summaries import rebuild_summaries
+from auditor.signals import mark_changed
+
+"""
+Runs a fake MTurk service on localhost so the other commands can be load tested offline.
+Point both endpoints at it in your settings, e.g.:
+
+MTURK_ENDPOINT = 'http://127.0.0.1:8765'
+MTURK_SANDBOX_ENDPOINT = 'http://127.0.0.1:8765'
+
+--populate fills the database with synthetic requesters, HITs, assignments and duration reports first.
+"""
+
+FAKE_REQUESTER = 'FAKEMTURKREQUESTER'
+
+class Command(BaseCommand):
+    help = 'Run a fake MTurk service for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0, help='Seconds added to every call')
+        parser.add_argument('--throttle-rate', type=int, dest='throttle_rate', default=None, help='Calls per second per account above which calls are throttled')
+        parser.add_argument('--balance', default='10000.00', help='Starting balance of every account')
+        parser.add_argument('--synthetic', default='Approved=0.6,Submitted=0.2,Rejected=0.05,Open=0.1,Missing=0.05', help='Status mix for assignments the fake has not been told about, over %s' % ', '.join(STATUSES))
+        parser.add_argument('--from-db', action='store_true', dest='from_db', help="Register the database's open, submitted and approved assignments and their HITs, so ListAssignmentsForHIT can find them and bonuses can be sent on them")
+        parser.add_argument('--populate', type=int, default=0, help='Create this many synthetic assignments in the database before serving')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            synthetic = {status: float(weight) for status, weight in (pair.split('=') for pair in options['synthetic'].split(','))}
+        except ValueError:
+            raise CommandError('--synthetic should look like Approved=0.6,Open=0.4')
+        if not set(synthetic.keys()) <= set(STATUSES):
+            raise CommandError('--synthetic statuses must be among %s' % ', '.join(STATUSES))
+
+        if options['populate']:
+            self.__populate(options['populate'], random.Random(options['seed']))
+
+        fake = FakeMTurk(synthetic = synthetic, latency = options['latency'], throttle_rate = options['throttle_rate'], balance = options['balance'])
+        if options['from_db']:
+            self.__register(fake)
+
+        server = make_server(fake, options['host'], options['port'])
+        self.stdout.write(self.style.SUCCESS('Fake MTurk listening on http://%s:%d' % server.server_address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for operation, count in sorted(fake.calls.items()):
+                self.stdout.write('%s: %d call%s' % (operation, count, '' if count == 1 else 's'))
+
+    def __register(self, fake):
+        statuses = [Assignment.OPEN, Assignment.SUBMITTED, Assignment.APPROVED]
+        hits = HIT.objects.filter(assignment__status__in = statuses).distinct().select_related('hit_type')
+        for hit in hits.iterator():
+            fake.add_hit(hit.id, hit.hit_type_id, reward = '%.2f' % hit.hit_type.payment)
+        assignments = Assignment.objects.filter(status__in = statuses).values_list('id', 'hit_id', 'worker_id', 'status')
+        count = 0
+        for assignment_id, hit_id, worker_id, status in assignments.iterator():
+            # the open and submitted ones get the synthetic mix, so polling finds something to do;
+            # the approved ones are bonused, and SendBonus only accepts assignments the fake knows
+            fake.add_assignment(assignment_id, hit_id, worker_id, 'Approved' if status == Assignment.APPROVED else None)
+            count += 1
+        self.stdout.write('Registered %d assignments' % count)
+
+    def __populate(self, num_assignments, rng):
+        """
+        Synthetic data in the proportions we see in practice: ~10 assignments per HIT,
+        ~100 HITs per HIT Type, ~20 assignments per worker, a few HIT Types per requester
+        """
+        batch_size = 5000
+        num_hits = max(1, num_assignments // 10)
+        num_hit_types = max(1, num_hits // 100)
+        num_workers = max(1, num_assignments // 20)
+        num_requesters = max(1, num_hit_types // 5)
+
+        requesters = []
+        for i in range(num_requesters):
+            requester, created = Requester.objects.get_or_create(aws_account = '%s%d' % (FAKE_REQUESTER, i), defaults = {'key': 'FAKEKEY%d' % i, 'secret': 'FAKESECRET', 'email': settings.ADMIN_EMAIL})
+            requesters.append(requester)
+
+        HITType.objects.bulk_create([
+            HITType(id = 'FAKEHITTYPE%d' % i, payment = Decimal(rng.randint(5, 200)) / 100, host = 'https://workersandbox.mturk.com', requester = requesters[i % num_requesters])
+            for i in range(num_hit_types)
+        ], batch_size = batch_size)
+        HIT.objects.bulk_create([
+            HIT(id = 'FAKEHIT%d' % i, hit_type_id = 'FAKEHITTYPE%d' % (i % num_hit_types))
+            for i in range(num_hits)
+        ], batch_size = batch_size)
+        Worker.objects.bulk_create([Worker(id = 'FAKEWORKER%d' % i) for i in range(num_workers)], batch_size = batch_size)
+
+        for start in range(0, num_assignments, batch_size):
+            ids = range(start, min(start + batch_size, num_assignments))
+            Assignment.objects.bulk_create([
+                Assignment(id = 'FAKEASSIGNMENT%d' % i, hit_id = 'FAKEHIT%d' % (i % num_hits), worker_id = 'FAKEWORKER%d' % rng.randrange(num_workers))
+                for i in ids
+            ])
+            AssignmentDuration.objects.bulk_create([
+                AssignmentDuration(assignment_id = 'FAKEASSIGNMENT%d' % i, duration = timedelta(seconds = rng.randint(30, 30*60)))
+                for i in ids
+            ])
+            self.stdout.write('Created %d of %d assignments' % (ids[-1] + 1, num_assignments))
+
+        # bulk_create sends no signals, so build the duration summaries and flag the HIT Types for auditpayments here,
+        # a few HIT Types at a time to keep the queries' id lists short
+        hit_type_ids = ['FAKEHITTYPE%d' % i for i in range(num_hit_types)]
+        for i in range(0, num_hit_types, 5):
+            rebuild_summaries(HIT.objects.filter(hit_type_id__in = hit_type_ids[i:i + 5]))
+        mark_changed(HITType.objects.filter(requester__in = requesters))
+        self.stdout.write('Summarized the reports of %d HIT Types' % num_hit_types)
@@ -1,140 +1,165 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.core.management import call_command
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.cache import caches
 from django.utils import timezone
-from django.db.models import Q
+from django.db.models import Q, Sum, Min, Max, Count
 
 import decimal
 from decimal import Decimal
 import itertools
+from collections import defaultdict
 from datetime import datetime, timedelta
 
 import boto3
 
-from auditor.models import HITType, HIT, Worker, Assignment, AssignmentDuration, AssignmentAudit, Requester
-from auditor.management.commands.pullnotifications import get_mturk_connection
+from auditor.models import HITType, HIT, Assignment, AssignmentDuration, AssignmentAudit, Requester, BonusPayment
+from auditor.freezes import get_frozen_workers
+from auditor.summaries import to_microseconds
 from auditor.management.commands import auditpayments
 
 """
-Pays bonuses for audited HITs that underpaid.
+Pays bonuses for audited HITs that underpaid. Each worker's bonus from each requester is
+queued as a BonusPayment, then drainbonuses sends the queued bonuses that are due. Queuing
+is idempotent: a bonus that is already queued under the same token is left as it is.
+A worker whose audits are on a bonus that MTurk may already have paid is left alone until
+that bonus is settled, by reconcilebonuses or by sending it again under its own token.
 """
 
 class Command(BaseCommand):
     help = 'Bonus underpayment for audited tasks'
 
-    mturk = dict() # maintains the Boto client connections
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'BONUS_WORKERS', 1), help='Number of threads sending bonuses concurrently. Bonuses are queued by requester, so each AWS account is paid by one thread at a time.')
+        parser.add_argument('--reconcile', action='store_true', help='Before queuing, close the queued bonuses that MTurk has already paid, e.g. after a crash')
 
     def handle(self, *args, **options):
-        self.__pay_audited_hits()
+        self.fragments = dict() # HIT Type summaries for worker messages already looked up this run, see __get_fragment
+        if options['reconcile']:
+            # first, so that audits MTurk already paid are closed rather than queued again under a new amount
+            call_command('reconcilebonuses', workers = options['workers'], stdout = self.stdout, stderr = self.stderr)
+        self.__queue_audited_hits()
+        # send what was just queued, along with any earlier bonuses that are due for another try
+        call_command('drainbonuses', workers = options['workers'], stdout = self.stdout, stderr = self.stderr)
 
     ###
-    ### Pay the HITs that need to be paid
+    ### Queue bonuses for the HITs that need to be paid
     ###
-    def __pay_audited_hits(self):
+    def __queue_audited_hits(self):
         grace_period_limit = timezone.now() - auditpayments.REQUESTER_GRACE_PERIOD
 
         self.stdout.write(self.style.WARNING('Grace period has ended for audits notified before %s' % timezone.localtime(grace_period_limit).strftime("%B %d at %-I:%M%p %Z")))
         for is_sandbox in [True, False]:
             self.stdout.write(self.style.WARNING('Sandbox mode: %s' % is_sandbox))
 
-            audits = AssignmentAudit.objects.filter(closed = False).filter(needsPayment = True).filter(message_sent__lte = grace_period_limit)
+            audits = AssignmentAudit.objects.filter(closed = False).filter(needsPayment = True).filter(message_sent__lte = grace_period_limit).filter(is_sandbox = is_sandbox)
+            self.__queue_bonuses(audits, is_sandbox)
 
-            if is_sandbox:
-                audits = audits.filter(assignment__hit__hit_type__host__contains = 'sandbox')
-            else:
-                audits = audits.exclude(assignment__hit__hit_type__host__contains = 'sandbox')
-
-            requesters = Requester.objects.filter(hittype__hit__assignment__assignmentaudit__in = audits).distinct()
-
-            for requester in requesters:
+    def __queue_bonuses(self, audits, is_sandbox):
+        """
+        Queues one bonus per worker and requester, covering all of the worker's audits for that
+        requester. The plan for the whole pass comes from one grouped query, and worker messages
+        are put together from cached HIT Type summaries.
+        """
+        # one row per requester, worker, HIT Type and estimate
+        rows = audits.order_by().values('requester_id', 'assignment__worker_id', 'hit_type_id', 'estimated_time', 'estimated_rate', 'payment').annotate(
+            first_hit = Min('assignment__hit_id'),
+            num_hits = Count('assignment__hit_id', distinct = True),
+            total_unpaid = Sum(auditpayments.underpayment_expression()),
+            num_audits = Count('id'),
+            num_queued = Count('bonus_id'),
+            first_bonus = Min('bonus_id'),
+            last_bonus = Max('bonus_id'),
+            num_may_be_paid = Count('bonus_id', filter = Q(bonus__may_be_paid = True)),
+        )
+        plan = defaultdict(list)
+        for row in rows:
+            plan[(row['requester_id'], row['assignment__worker_id'])].append(row)
+
+        requesters = Requester.objects.in_bulk(set(requester_id for requester_id, worker_id in plan))
+        hit_types = HITType.objects.in_bulk(set(row['hit_type_id'] for worker_rows in plan.values() for row in worker_rows))
+        queued = BonusPayment.objects.in_bulk(set(row['first_bonus'] for worker_rows in plan.values() for row in worker_rows if row['first_bonus'] is not None))
+        first_assignments = self.__get_first_assignments(audits, plan)
+
+        last_requester_id = None
+        for (requester_id, worker_id), worker_rows in sorted(plan.items()):
+            requester = requesters[requester_id]
+            if requester_id != last_requester_id:
                 self.stdout.write(self.style.WARNING('Requester: %s %s' % (requester.aws_account, requester.email)))
-
-                requester_to_bonus = audits.filter(assignment__hit__hit_type__requester = requester).order_by('assignment__hit', 'assignment__hit__hit_type', 'assignment__worker')
-
-                workers = Worker.objects.filter(assignment__assignmentaudit__in = requester_to_bonus).distinct()
-                for worker in workers:
-                    assignments_to_bonus = requester_to_bonus.filter(assignment__worker = worker).distinct()
-                    self.__bonus_worker(worker, assignments_to_bonus, requester, is_sandbox)
-
-                # The assignments still listed as unpaid indicate that the requester didn't have sufficient funds
-                still_unpaid = requester_to_bonus.filter(needsPayment = True).filter(frozen = False)
-                still_unpaid = still_unpaid.all() # refreshes the queryset from the DB, since we just changed payment status of a bunch of items
-                if len(still_unpaid) > 0:
-                    self.__notify_insufficient_funds_requester(requester, still_unpaid)
-
-    def __bonus_worker(self, worker, assignments_to_bonus, requester, is_sandbox):
-        self.stdout.write(self.style.WARNING('Worker: %s' % worker.id))
-        total_unpaid = auditpayments.get_underpayment(assignments_to_bonus)
-
-        self.stdout.write(self.style.WARNING('Total bonus for %s: $%.2f\n---------' % (worker.id, total_unpaid)))
-
-        # Send the bonus
-        # Construct the message to the worker
-        message = auditpayments.audit_list_message(assignments_to_bonus, requester, True, False, is_sandbox)
-
-        # Bonus worker on first assignment in the HITGroup (to avoid being spammy) and keep a record
-        assignment_to_bonus = assignments_to_bonus[0] # Arbitrarily attach it to the first one
-        token = '%s: %.2f' % (assignment_to_bonus.assignment.id, total_unpaid) # sending the same token prevents AMT from sending the same bonus twice
-
-        mturk_clients = get_mturk_connection(requester, self.mturk)
-        if is_sandbox:
-            mturk_client = mturk_clients['sandbox']
-        else:
-            mturk_client = mturk_clients['production']
-
-        try:
-            response = mturk_client.send_bonus(WorkerId = worker.id, BonusAmount = '%.2f' % (total_unpaid), AssignmentId = assignment_to_bonus.assignment.id, Reason = message, UniqueRequestToken = token)
-
-            # Once the bonus is sent, mark the audits as paid
-            # Maybe now just turn everything into closed...
-            for unpaid_task in assignments_to_bonus:
-                unpaid_task.closed = True
-                unpaid_task.save()
-        except mturk_client.exceptions.RequestError as e:
-            if e.response['Error']['Message'].startswith("This Requester has insufficient funds in their account to complete this transaction."):
-                self.stderr.write(self.style.ERROR("Requester does not have enough funds. Notifying worker."))
-                self.__notify_insufficient_funds_worker(requester, is_sandbox, worker, total_unpaid, assignment_to_bonus)
-            elif e.response['Error']['Message'].startswith("The idempotency token"): # has already been processed
-                self.stderr.write(self.style.ERROR("Identical bonus has already been paid on this task. Skipping."))
-                # They already paid it, mark it as done
-                for unpaid_task in assignments_to_bonus:
-                    unpaid_task.closed = True
-                    unpaid_task.save()
-            else:
-                self.stderr.write(self.style.ERROR(e))
-
-    def __notify_insufficient_funds_worker(self, requester, is_sandbox, worker, total_unpaid, assignment_to_bonus):
+                last_requester_id = requester_id
+            # frozen workers aren't paid, including for audits made after the freeze
+            if worker_id in get_frozen_workers(requester_id):
+                continue
+            if sum(row['num_may_be_paid'] for row in worker_rows) > 0:
+                # moving these audits to a new bonus could pay them twice
+                self.stdout.write(self.style.WARNING('Worker: %s may already have been paid; waiting for their bonus to be reconciled' % worker_id))
+                continue
+
+            self.stdout.write(self.style.WARNING('Worker: %s' % worker_id))
+            total_unpaid = auditpayments.round_up_to_cent(sum(Decimal(row['total_unpaid']) for row in worker_rows if row['total_unpaid'] is not None))
+            self.stdout.write(self.style.WARNING('Total bonus for %s: $%.2f\n---------' % (worker_id, total_unpaid)))
+
+            # leave a bonus that already covers exactly these audits, for this amount, as it is
+            bonus_ids = set(row['first_bonus'] for row in worker_rows) | set(row['last_bonus'] for row in worker_rows)
+            if sum(row['num_queued'] for row in worker_rows) == sum(row['num_audits'] for row in worker_rows) and len(bonus_ids) == 1:
+                bonus = queued[bonus_ids.pop()]
+                if bonus.amount == total_unpaid and bonus.status in BonusPayment.OPEN_STATUSES:
+                    continue
+
+            # Bonus worker on the assignment in their first HIT (to avoid being spammy) and keep a record
+            assignment_id = first_assignments[(requester_id, worker_id)]
+            token = '%s: %.2f' % (assignment_id, total_unpaid) # sending the same token prevents AMT from sending the same bonus twice
+
+            bonus = BonusPayment.objects.filter(token = token).first()
+            if bonus is None:
+                # Construct the message to the worker
+                fragments = [self.__get_fragment(hit_types[row['hit_type_id']], row, is_sandbox) for row in sorted(worker_rows, key = lambda row: row['hit_type_id'])]
+                message = auditpayments.render_worker_message(total_unpaid, fragments, is_sandbox)
+                bonus = BonusPayment.objects.create(token = token, requester_id = requester_id, worker_id = worker_id, assignment_id = assignment_id, is_sandbox = is_sandbox, amount = total_unpaid, reason = message)
+            elif bonus.status == BonusPayment.CANCELLED:
+                # e.g., the worker was frozen and then unfrozen
+                bonus.status = BonusPayment.PENDING
+                bonus.next_attempt_at = None
+                bonus.save(update_fields = ['status', 'next_attempt_at', 'timestamp'])
+
+            # audits that were queued under another amount move to this bonus, and drainbonuses cancels the old one
+            audits.filter(requester_id = requester_id, assignment__worker_id = worker_id).update(bonus = bonus)
+            if bonus.status == BonusPayment.PAID:
+                # already sent, so the audits should have been closed
+                AssignmentAudit.objects.filter(bonus = bonus).update(closed = True, timestamp = timezone.now())
+
+    def __get_first_assignments(self, audits, plan, chunk_size = 500):
         """
-        Tells the worker to tell the requester to deposit more money.
-        Then, emails the requester.
+        Returns {(requester id, worker id): the worker's assignment in the first of their HITs},
+        which is where bonuses have always gone, so a bonus queued again keeps its token
         """
-
-        subject = "Fair Work bonus of $%.2f pending, but requester out of funds — please notify requester" % total_unpaid
-
-        message = """This is an automated message from the Fair Work script: this requester is trying to bonus you, but they don't have enough funds in their account to send the bonus. Please reply and let them know that they need to deposit more funds.
-This requester is using the Fair Work script to ensure pay rates reach a minimum wage of $%.2f/hr. Fair Work does this by asking for completion times and then auto-bonusing workers to meet the desired hourly wage. Based on worker time reports, your tasks have been underpaid. We are bonusing you to bring you back up to $%.2f/hr. The total bonus will be $%.2f.
-We will try to send the bonus again periodically, so you will get paid after they deposit more funds.
-        """ % (settings.MINIMUM_WAGE_PER_HOUR, settings.MINIMUM_WAGE_PER_HOUR, total_unpaid)
-
-        mturk_clients = get_mturk_connection(requester, self.mturk)
-        if is_sandbox:
-            mturk_client = mturk_clients['sandbox']
-        else:
-            mturk_client = mturk_clients['production']
-
-        try:
-            response = mturk_client.notify_workers(Subject = subject, MessageText = message, WorkerIds = [worker.id])
-
-        except mturk_client.exceptions.RequestError as e:
-            self.stderr.write(self.style.ERROR(e))
-
-    def __notify_insufficient_funds_requester(self, requester, unpaid_assignments):
-        total_underpaid = auditpayments.get_underpayment(unpaid_assignments)
-        total_deposit = total_underpaid * Decimal('1.20') # AMT bonus fee rate
-        subject = "Error: Fair Work bonuses are pending but you are out of funds. Please deposit $%.2f." % total_deposit
-        message = """This is an automated message from the Fair Work script: you have underpaid workers and need to bonus them, but you don't have enough funds in your account to send the bonus. You need to send bonuses totaling $%.2f, but with Mechanical Turk's fee, you need to deposit $%.2f to have enough funds to send those bonuses. Please deposit more funds, and we will automatically retry in roughly 24 hours.
-We are sending you this note because you are using the Fair Work script to ensure Mechanical Turk pay rates reach a minimum wage of $%.2f/hr. Fair Work does this by asking for completion times and then auto-bonusing workers to meet the desired hourly wage. Based on worker time reports, your tasks have been underpaid.
-        """ % (total_underpaid, total_deposit, settings.MINIMUM_WAGE_PER_HOUR)
-
-        send_mail(subject, message, auditpayments.admin_email_address(), [requester.email], fail_silently=False)
-        self.stdout.write(message)
+        first_hits = dict((key, min(row['first_hit'] for row in worker_rows)) for key, worker_rows in plan.items())
+        hit_ids = sorted(set(first_hits.values()))
+        hit_assignments = dict()
+        for i in range(0, len(hit_ids), chunk_size):
+            rows = audits.filter(assignment__hit_id__in = hit_ids[i:i + chunk_size]).order_by().values_list('requester_id', 'assignment__worker_id', 'assignment__hit_id').annotate(first_assignment = Min('assignment_id'))
+            for requester_id, worker_id, hit_id, assignment_id in rows:
+                hit_assignments[(requester_id, worker_id, hit_id)] = assignment_id
+        return dict((key, hit_assignments[key + (hit_id,)]) for key, hit_id in first_hits.items())
+
+    def __get_fragment(self, hit_type, row, is_sandbox):
+        """
+        The worker-facing summary of a HIT Type. Each one is rendered once and kept in the Django
+        cache, so it's only rendered again when the HIT Type's estimate changes.
+        """
+        key = get_fragment_key(hit_type, row, is_sandbox)
+        if key not in self.fragments:
+            cache = caches[getattr(settings, 'MESSAGE_FRAGMENT_CACHE', 'default')]
+            fragment = cache.get(key)
+            if fragment is None:
+                audit = AssignmentAudit(estimated_time = row['estimated_time'], estimated_rate = row['estimated_rate'], payment = row['payment'])
+                fragment = auditpayments.render_worker_fragment(hit_type, audit, row['num_hits'])
+                cache.set(key, fragment, getattr(settings, 'MESSAGE_FRAGMENT_CACHE_TIMEOUT', 7*24*60*60))
+            self.fragments[key] = fragment
+        return self.fragments[key]
+
+def get_fragment_key(hit_type, row, is_sandbox):
+    # everything the summary depends on: the HIT Type and its payment, the estimate, the
+    # minimum wage, and whether the worker did one HIT or more
+    estimated_time = to_microseconds(row['estimated_time']) if row['estimated_time'] is not None else None
+    return 'worker-fragment:%s:%s:%s:%s:%s:%s:%s:%s' % (hit_type.id, hit_type.payment, row['payment'], estimated_time, row['estimated_rate'], settings.MINIMUM_WAGE_PER_HOUR, is_sandbox, 'one' if row['num_hits'] == 1 else 'many')
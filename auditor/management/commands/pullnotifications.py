@@ -1,91 +1,312 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
 from auditor.models import HITType, HIT, Worker, Assignment, Requester
+from auditor.mturk import get_mturk_client, MTURK_ERRORS
+from auditor.signals import mark_changed
 
-import boto3
 import json
-from datetime import timedelta
+import itertools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 class Command(BaseCommand):
     help = 'Checks for completed HITs and updates the database'
 
-    mturk = dict() # maintains the Boto client connections
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'MTURK_POLL_WORKERS', 1), help='Number of threads polling MTurk concurrently. Assignments are sharded by requester and host, so each AWS account is polled by one thread at a time.')
+        parser.add_argument('--by-hit', action='store_true', dest='by_hit', help='Reconcile assignments a HIT at a time with ListAssignmentsForHIT instead of calling GetAssignment for each assignment.')
+        parser.add_argument('--all', action='store_true', dest='poll_all', help='Check every open and submitted assignment, not just the ones that are due.')
 
     def handle(self, *args, **options):
         # get all Assignments in Open or Submitted status, and update them to Accepted/Rejected so that we can audit
+        self.now = timezone.now()
         assignments = Assignment.objects.filter(Q(status = Assignment.OPEN) | Q(status = Assignment.SUBMITTED))
+        if not options['poll_all']:
+            assignments = assignments.filter(Q(next_poll_at__isnull = True) | Q(next_poll_at__lte = self.now))
+        assignments = assignments.select_related('hit__hit_type__requester').order_by('hit__hit_type__requester', 'hit__hit_type__host', 'id')
 
-        for assignment in assignments:
-            self.stdout.write(assignment.id)
-            hit_type = assignment.hit.hit_type
-            self.stdout.write(hit_type.id)
-            self.stdout.write(hit_type.requester.aws_account)
-            mturk_clients = get_mturk_connection(hit_type.requester, self.mturk)
-            if hit_type.is_sandbox():
-                mturk_client = mturk_clients['sandbox']
-            else:
-                mturk_client = mturk_clients['production']
+        # Shard by (requester, host) so that calls to different AWS accounts overlap,
+        # while each account still sees its own requests one at a time
+        shards = []
+        for (aws_account, host), shard in itertools.groupby(assignments, key = lambda a: (a.hit.hit_type.requester_id, a.hit.hit_type.host)):
+            shard = list(shard)
+            hit_type = shard[0].hit.hit_type
+            # Boto clients are looked up on this thread; clients (unlike sessions) are safe to share across threads
+            shards.append((get_mturk_client(hit_type.requester, hit_type.is_sandbox()), shard))
 
+        # HIT metadata learned from MTurk during this run, keyed by HIT id.
+        # Worker threads fill it in; the main thread saves it on the HIT afterwards.
+        self.hit_metadata = dict()
+
+        poll_shard = self.__poll_shard_by_hit if options['by_hit'] else self.__poll_shard
+        workers = max(1, options['workers'])
+        if workers == 1:
+            results = map(poll_shard, shards)
+            transitions, schedule = self.__collect_results(results)
+        else:
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                # map() yields shards in submission order, which keeps the output deterministic
+                results = executor.map(poll_shard, shards)
+                transitions, schedule = self.__collect_results(results)
+
+        save_poll_schedule(schedule)
+        counts = save_status_transitions(transitions)
+        for status, count in sorted(counts.items()):
+            self.stdout.write(self.style.SUCCESS('%d assignment%s moved to %s' % (count, '' if count == 1 else 's', dict(Assignment.STATUS_CHOICES)[status])))
+
+        for hit_id, hit_metadata in self.hit_metadata.items():
+            HIT.objects.filter(id = hit_id).update(
+                assignment_duration_seconds = hit_metadata['AssignmentDurationInSeconds'],
+                auto_approval_delay_seconds = hit_metadata.get('AutoApprovalDelayInSeconds')
+            )
+
+    def __poll_shard(self, shard):
+        mturk_client, assignments = shard
+        return [(assignment, self.__poll_assignment(mturk_client, assignment)) for assignment in assignments]
+
+    def __poll_shard_by_hit(self, shard):
+        mturk_client, assignments = shard
+        results = []
+        for hit_id, hit_assignments in itertools.groupby(sorted(assignments, key = lambda a: (a.hit_id, a.id)), key = lambda a: a.hit_id):
+            hit_assignments = list(hit_assignments)
             try:
-                amt_response = mturk_client.get_assignment(AssignmentId = assignment.id)
-                # Since we can't guarantee that the HIT has been approved yet, we need to check
-                status = amt_response['Assignment']['AssignmentStatus']
-                if status == 'Submitted':
-                    # Submitted means it hasn't been reviewed yet
-                    assignment.status = Assignment.SUBMITTED
-                elif status == 'Rejected':
-                    # if it's been rejected, don't include it in the audit:
-                    # if this requester is trustable, there should be a good reason
-                    # a future version should try to intercede on rejections and prevent wage theft
-                    assignment.status = Assignment.REJECTED
-                elif status == 'Approved':
-                    assignment.status = Assignment.APPROVED
-                self.stdout.write('\t%s' % assignment.get_status_display())
-
-                assignment.save()
-
-            except mturk_client.exceptions.RequestError as e:
-                if e.response['Error']['Message'].startswith('This operation can be called with a status of: Reviewable,Approved,Rejected'):
-                    # it's either still checked out, or returned
-                    # keep it in the queue unless the HIT is done
-                    try:
-                        hit_response = mturk_client.get_hit(HITId = assignment.hit.id)
-                        assignment_lifetime = hit_response['HIT']['AssignmentDurationInSeconds']
-                        max_time_alive = assignment.timestamp + timedelta(seconds = assignment_lifetime)
-
-                        if timezone.now() > max_time_alive:
-                            # the assignment has timed out, this assignment was likely a return
-                            self.stderr.write(self.style.ERROR('Assignment %s is past its maximum duration. Likely a returned assignment. Disabling polling for it.' % (assignment.id)))
-                            assignment.status = Assignment.EXPIRED
-                            assignment.save()
-                    except mturk_client.exceptions.RequestError as e2:
-                        self.stderr.write(self.style.ERROR(e2))
-                elif e.response['Error']['Message'].startswith('Assignment %s does not exist.' % assignment.id):
-                    self.stderr.write(self.style.ERROR('%s is not a known assignment. Disabling polling for it.' % assignment.id))
-                    assignment.status = Assignment.ERROR
-                    assignment.save()
-
-
-def get_mturk_connection(requester, mturk):
-    if requester.aws_account in mturk:
-        return mturk[requester.aws_account]
-    else:
-        connection = boto3.client('mturk',
-            aws_access_key_id=requester.key,
-            aws_secret_access_key=requester.secret,
-            region_name='us-east-1',
-            endpoint_url = settings.MTURK_ENDPOINT
-        )
-        connection_sandbox = boto3.client('mturk',
-            aws_access_key_id=requester.key,
-            aws_secret_access_key=requester.secret,
-            region_name='us-east-1',
-            endpoint_url = settings.MTURK_SANDBOX_ENDPOINT
-        )
-        mturk[requester.aws_account] = {
-            'production': connection,
-            'sandbox': connection_sandbox
+                amt_assignments = list_hit_assignments(mturk_client, hit_id)
+            except mturk_client.exceptions.RequestError:
+                # e.g., an unknown HIT: let the per-assignment checks decide what to do with each one
+                amt_assignments = dict()
+            except MTURK_ERRORS as e:
+                # e.g., throttled or disconnected past the retry budget: skip the HIT's assignments, which stay due for the next run
+                for assignment in hit_assignments:
+                    log = self.__log_header(assignment)
+                    log.append((True, 'Could not list the assignments of %s: %s' % (hit_id, e)))
+                    results.append((assignment, (None, log, None, False)))
+                continue
+
+            for assignment in hit_assignments:
+                if assignment.id in amt_assignments:
+                    log = self.__log_header(assignment)
+                    new_status, due = self.__status_from_mturk(assignment, amt_assignments[assignment.id], log)
+                    results.append((assignment, (new_status, log, due, True)))
+                else:
+                    # Not in the listing: it's still checked out, was returned, or never existed.
+                    # The single-assignment path knows how to tell these apart.
+                    results.append((assignment, self.__poll_assignment(mturk_client, assignment)))
+        # report in the same order as the per-assignment mode
+        results.sort(key = lambda result: result[0].id)
+        return results
+
+    def __collect_results(self, results):
+        # Output happens here, on the main thread. Returns the status changes and poll schedule to write.
+        transitions = dict()
+        schedule = dict()
+        for shard_results in results:
+            for assignment, (status, log, due, checked) in shard_results:
+                for is_error, line in log:
+                    if is_error:
+                        self.stderr.write(self.style.ERROR(line))
+                    else:
+                        self.stdout.write(line)
+                if not checked:
+                    # left as it was, so it's polled again on the next run
+                    continue
+                changed = status is not None and status != assignment.status
+                if changed:
+                    transitions[assignment.id] = status
+                if (status or assignment.status) in (Assignment.OPEN, Assignment.SUBMITTED):
+                    schedule[assignment.id] = get_next_poll(assignment, changed, due, self.now)
+        return transitions, schedule
+
+    def __poll_assignment(self, mturk_client, assignment):
+        """
+        Asks MTurk for the assignment's status. Runs on a worker thread, so it
+        must not touch the database: it returns the new status (or None to leave
+        the assignment unchanged), the lines to log for this assignment, when
+        its status is next expected to change on its own (or None if unknown),
+        and whether MTurk answered at all (False if e.g. the call was throttled, or the connection dropped).
+        """
+        log = self.__log_header(assignment)
+        new_status = None
+        due = None
+        checked = True
+
+        try:
+            amt_response = mturk_client.get_assignment(AssignmentId = assignment.id)
+            # Since we can't guarantee that the HIT has been approved yet, we need to check
+            new_status, due = self.__status_from_mturk(assignment, amt_response['Assignment'], log)
+
+        except mturk_client.exceptions.RequestError as e:
+            if e.response['Error']['Message'].startswith('This operation can be called with a status of: Reviewable,Approved,Rejected'):
+                # it's either still checked out, or returned
+                # keep it in the queue unless the HIT is done
+                try:
+                    assignment_lifetime = assignment.hit.assignment_duration_seconds
+                    if assignment_lifetime is None:
+                        hit_metadata = get_hit_metadata(mturk_client, assignment.hit.hit_type.host, assignment.hit_id)
+                        assignment_lifetime = hit_metadata['AssignmentDurationInSeconds']
+                        self.hit_metadata[assignment.hit_id] = hit_metadata
+                    max_time_alive = assignment.timestamp + timedelta(seconds = assignment_lifetime)
+
+                    if timezone.now() > max_time_alive:
+                        # the assignment has timed out, this assignment was likely a return
+                        log.append((True, 'Assignment %s is past its maximum duration. Likely a returned assignment. Disabling polling for it.' % (assignment.id)))
+                        new_status = Assignment.EXPIRED
+                    else:
+                        due = max_time_alive
+                except mturk_client.exceptions.RequestError as e2:
+                    log.append((True, str(e2)))
+                except MTURK_ERRORS as e2:
+                    log.append((True, 'Could not look up %s: %s' % (assignment.hit_id, e2)))
+                    checked = False
+            elif e.response['Error']['Message'].startswith('Assignment %s does not exist.' % assignment.id):
+                log.append((True, '%s is not a known assignment. Disabling polling for it.' % assignment.id))
+                new_status = Assignment.ERROR
+
+        except MTURK_ERRORS as e:
+            # e.g., throttled or disconnected past the retry budget: skip it rather than lose the rest of the poll
+            log.append((True, 'Could not check %s: %s' % (assignment.id, e)))
+            checked = False
+
+        return new_status, log, due, checked
+
+    def __log_header(self, assignment):
+        hit_type = assignment.hit.hit_type
+        return [(False, assignment.id), (False, hit_type.id), (False, hit_type.requester_id)]
+
+    def __status_from_mturk(self, assignment, amt_assignment, log):
+        status = amt_assignment['AssignmentStatus']
+        new_status = assignment.status
+        due = None
+        if status == 'Submitted':
+            # Submitted means it hasn't been reviewed yet
+            new_status = Assignment.SUBMITTED
+        elif status == 'Rejected':
+            # if it's been rejected, don't include it in the audit:
+            # if this requester is trustable, there should be a good reason
+            # a future version should try to intercede on rejections and prevent wage theft
+            new_status = Assignment.REJECTED
+        elif status == 'Approved':
+            new_status = Assignment.APPROVED
+        log.append((False, '\t%s' % dict(Assignment.STATUS_CHOICES)[new_status]))
+
+        if new_status == Assignment.SUBMITTED:
+            # unless the requester reviews it first, it gets approved automatically
+            due = amt_assignment.get('AutoApprovalTime')
+            if due is None and assignment.hit.auto_approval_delay_seconds is not None:
+                due = assignment.timestamp + timedelta(seconds = assignment.hit.auto_approval_delay_seconds)
+        return new_status, due
+
+
+def save_status_transitions(transitions, chunk_size = 500):
+    """
+    Writes {assignment id: new status} to the database in one transaction, with one
+    UPDATE per status per chunk of ids rather than one save() per assignment.
+    Returns a Counter of how many assignments moved to each status.
+    """
+    by_status = dict()
+    for assignment_id, status in sorted(transitions.items()):
+        by_status.setdefault(status, []).append(assignment_id)
+
+    counts = Counter()
+    now = timezone.now()
+    with transaction.atomic():
+        for status, assignment_ids in by_status.items():
+            for i in range(0, len(assignment_ids), chunk_size):
+                chunk = assignment_ids[i:i + chunk_size]
+                # update() skips auto_now, so the timestamp is set by hand, as save() would have
+                counts[status] += Assignment.objects.filter(id__in = chunk).update(status = status, timestamp = now)
+                # update() sends no post_save, so flag the HIT Types for auditpayments here
+                mark_changed(HITType.objects.filter(hit__assignment__id__in = chunk))
+    return counts
+
+def get_next_poll(assignment, changed, due, now):
+    """
+    Decides when to check the assignment again. Returns (next_poll_at, poll_backoff).
+
+    Each check that finds nothing new doubles the wait, starting from MTURK_POLL_INTERVAL;
+    a change starts it over. The wait is at least a quarter of the time since the assignment
+    last changed, and at most MTURK_MAX_POLL_INTERVAL. If we know when the status will change
+    on its own (the assignment expires, or is auto-approved) we check again right after that.
+    Times are rounded up to MTURK_POLL_GRANULARITY so that assignments share schedule updates.
+    """
+    base_interval = getattr(settings, 'MTURK_POLL_INTERVAL', timedelta(minutes = 15))
+    max_interval = getattr(settings, 'MTURK_MAX_POLL_INTERVAL', timedelta(days = 1))
+    granularity = getattr(settings, 'MTURK_POLL_GRANULARITY', timedelta(minutes = 5))
+
+    poll_backoff = 0 if changed else assignment.poll_backoff + 1
+    # stop counting once the wait is capped, so the column can't grow without bound
+    while poll_backoff > 0 and base_interval * (2 ** (poll_backoff - 1)) >= max_interval:
+        poll_backoff -= 1
+
+    age = timedelta(0) if changed else now - assignment.timestamp
+    interval = min(max(base_interval * (2 ** poll_backoff), age / 4), max_interval)
+    next_poll_at = now + interval
+    if due is not None and now < due < next_poll_at:
+        next_poll_at = due
+
+    # round up to the granularity
+    remainder = (next_poll_at - datetime.min.replace(tzinfo = next_poll_at.tzinfo)) % granularity
+    if remainder:
+        next_poll_at += granularity - remainder
+    return next_poll_at, poll_backoff
+
+def save_poll_schedule(schedule, chunk_size = 500):
+    """
+    Writes {assignment id: (next_poll_at, poll_backoff)} to the database in one transaction,
+    with one UPDATE per distinct schedule per chunk of ids.
+    """
+    by_schedule = dict()
+    for assignment_id, poll_schedule in sorted(schedule.items()):
+        by_schedule.setdefault(poll_schedule, []).append(assignment_id)
+
+    with transaction.atomic():
+        for (next_poll_at, poll_backoff), assignment_ids in by_schedule.items():
+            for i in range(0, len(assignment_ids), chunk_size):
+                chunk = assignment_ids[i:i + chunk_size]
+                # update() leaves the auto_now timestamp alone, which the schedule relies on
+                Assignment.objects.filter(id__in = chunk).update(next_poll_at = next_poll_at, poll_backoff = poll_backoff)
+
+def get_hit_metadata(mturk_client, host, hit_id):
+    """
+    Returns the GetHIT fields we rely on (HITTypeId, Reward, AssignmentDurationInSeconds and AutoApprovalDelayInSeconds).
+    None of them change over the life of a HIT, so responses are kept in the Django cache,
+    keyed by host and HIT id, for MTURK_HIT_CACHE_TIMEOUT seconds. Eviction is up to the
+    cache backend (memcached and Django's local-memory cache both evict least recently used).
+    """
+    cache = caches[getattr(settings, 'MTURK_HIT_CACHE', 'default')]
+    cache_key = 'mturk-hit:%s:%s' % (host, hit_id)
+    hit_metadata = cache.get(cache_key)
+    if hit_metadata is None:
+        hit_response = mturk_client.get_hit(HITId = hit_id)
+        hit_metadata = {
+            'HITTypeId': hit_response['HIT']['HITTypeId'],
+            'Reward': hit_response['HIT']['Reward'],
+            'AssignmentDurationInSeconds': hit_response['HIT']['AssignmentDurationInSeconds'],
+            'AutoApprovalDelayInSeconds': hit_response['HIT'].get('AutoApprovalDelayInSeconds')
         }
-        return mturk[requester.aws_account]
+        cache.set(cache_key, hit_metadata, getattr(settings, 'MTURK_HIT_CACHE_TIMEOUT', 60*60))
+    return hit_metadata
+
+def list_hit_assignments(mturk_client, hit_id):
+    """
+    Returns {AssignmentId: Assignment} for every submitted, approved or
+    rejected assignment in the HIT, paging through ListAssignmentsForHIT.
+    Assignments that are still checked out or were returned are not listed.
+    """
+    amt_assignments = dict()
+    kwargs = {
+        'HITId': hit_id,
+        'AssignmentStatuses': ['Submitted', 'Approved', 'Rejected'],
+        'MaxResults': 100
+    }
+    while True:
+        response = mturk_client.list_assignments_for_hit(**kwargs)
+        for amt_assignment in response['Assignments']:
+            amt_assignments[amt_assignment['AssignmentId']] = amt_assignment
+        if not response['Assignments'] or 'NextToken' not in response:
+            return amt_assignments
+        kwargs['NextToken'] = response['NextToken']
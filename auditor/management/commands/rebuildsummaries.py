@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from auditor.models import HIT, HITDurationSummary, HITTypeDurationSummary
+from auditor.summaries import rebuild_summaries
+
+"""
+Recomputes the duration summaries that audits read medians from. They are kept up to
+date as reports come in, so this is only needed if reports were changed with update()
+or loaded from a fixture, which bypass the signals that maintain the summaries.
+"""
+
+class Command(BaseCommand):
+    help = 'Recomputes the per-HIT and per-HIT Type median duration summaries from the reports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hit-type', action='append', dest='hit_types', help='Only rebuild this HIT Type (can be repeated)')
+
+    def handle(self, *args, **options):
+        hits = HIT.objects.all()
+        if options['hit_types']:
+            hits = hits.filter(hit_type_id__in = options['hit_types'])
+
+        rebuild_summaries(hits)
+        self.stdout.write(self.style.SUCCESS('Rebuilt %d HIT summaries and %d HIT Type summaries' % (HITDurationSummary.objects.filter(hit__in = hits).count(), HITTypeDurationSummary.objects.filter(hit_type__hit__in = hits).distinct().count())))
@@ -0,0 +1,125 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from decimal import Decimal
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from auditor.models import BonusPayment
+from auditor.mturk import get_mturk_client, MTURK_ERRORS
+from auditor.management.commands.drainbonuses import mark_paid
+
+"""
+Finds queued bonuses that MTurk has already paid, e.g. because drainbonuses stopped after
+sending them but before recording it, and closes them with their audits without sending
+them again. MTurk lists the bonuses paid on a HIT, so this takes one read per HIT with
+queued bonuses, instead of one SendBonus per bonus that fails on its idempotency token.
+
+A bonus MTurk lists matches a queued one if it was paid on the same assignment, to the same
+worker, for the same amount: what the queued bonus's idempotency token stands for.
+Only bonuses marked may_be_paid are checked, unless --all is given. Those that MTurk hasn't
+paid lose the mark, so payaudits can move their audits to a new bonus again.
+Run payaudits --reconcile to reconcile before queuing.
+"""
+
+class Command(BaseCommand):
+    help = 'Closes the queued bonuses that MTurk has already paid'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requester', action='append', dest='requesters', help='Only reconcile the bonuses of this AWS account (can be repeated)')
+        parser.add_argument('--all', action='store_true', dest='check_all', help='Check every queued or failed bonus, not just those that MTurk may have paid')
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'BONUS_WORKERS', 1), help='Number of threads reading from MTurk concurrently, one requester per thread')
+
+    def handle(self, *args, **options):
+        # failed bonuses are included: MTurk may have paid them even though the response was an error
+        bonuses = BonusPayment.objects.filter(status__in = BonusPayment.OPEN_STATUSES + (BonusPayment.FAILED,))
+        if not options['check_all']:
+            bonuses = bonuses.filter(may_be_paid = True)
+        if options['requesters']:
+            bonuses = bonuses.filter(requester_id__in = options['requesters'])
+        bonuses = bonuses.select_related('requester', 'assignment').order_by('-is_sandbox', 'requester_id', 'assignment__hit_id', 'id')
+
+        # as in drainbonuses, the database is only touched on the main thread
+        queues = []
+        for (requester_id, is_sandbox), requester_bonuses in itertools.groupby(bonuses, key = lambda bonus: (bonus.requester_id, bonus.is_sandbox)):
+            requester_bonuses = list(requester_bonuses)
+            hits = [(hit_id, list(hit_bonuses)) for hit_id, hit_bonuses in itertools.groupby(requester_bonuses, key = lambda bonus: bonus.assignment.hit_id)]
+            requester = requester_bonuses[0].requester
+            queues.append({'requester': requester, 'is_sandbox': is_sandbox, 'mturk_client': get_mturk_client(requester, is_sandbox), 'hits': hits})
+
+        self.num_checked = 0
+        self.num_paid = 0
+        self.num_reads = 0
+        workers = max(1, options['workers'])
+        if workers == 1:
+            self.__collect_results(map(self.__find_paid_bonuses, queues))
+        else:
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                self.__collect_results(executor.map(self.__find_paid_bonuses, queues))
+
+        self.stdout.write(self.style.SUCCESS('%d of %d queued bonuses were already paid (%d calls to ListBonusPayments)' % (self.num_paid, self.num_checked, self.num_reads)))
+
+    def __find_paid_bonuses(self, queue):
+        """
+        Lists what MTurk paid on each HIT of the requester's queued bonuses. Runs on a worker thread,
+        so it must not touch the database: it returns the queue, the ids of the bonuses that were
+        paid, the ids of those that were checked but not paid, the number of reads, and the lines to log.
+        """
+        mturk_client = queue['mturk_client']
+        paid_ids = []
+        unpaid_ids = []
+        num_reads = 0
+        log = []
+        for hit_id, bonuses in queue['hits']:
+            # a lone bonus is looked up by its assignment, which lists no other assignments' bonuses
+            if len(bonuses) == 1:
+                params = {'AssignmentId': bonuses[0].assignment_id}
+            else:
+                params = {'HITId': hit_id}
+
+            paid = set()
+            try:
+                for response in list_bonus_payments(mturk_client, **params):
+                    num_reads += 1
+                    paid.update((payment['AssignmentId'], payment['WorkerId'], Decimal(payment['BonusAmount'])) for payment in response['BonusPayments'])
+            except MTURK_ERRORS as e:
+                # leave them queued: sending them is still safe, thanks to their tokens
+                log.append((True, 'Could not list the bonuses paid on %s: %s' % (hit_id, e)))
+                continue
+
+            for bonus in bonuses:
+                if (bonus.assignment_id, bonus.worker_id, bonus.amount) in paid:
+                    log.append((False, "%s's bonus of $%.2f on %s has already been paid." % (bonus.worker_id, bonus.amount, bonus.assignment_id)))
+                    paid_ids.append(bonus.id)
+                else:
+                    unpaid_ids.append(bonus.id)
+        return queue, paid_ids, unpaid_ids, num_reads, log
+
+    def __collect_results(self, results):
+        for queue, paid_ids, unpaid_ids, num_reads, log in results:
+            self.stdout.write(self.style.WARNING('Requester: %s %s (sandbox: %s)' % (queue['requester'].aws_account, queue['requester'].email, queue['is_sandbox'])))
+            for is_error, line in log:
+                if is_error:
+                    self.stderr.write(self.style.ERROR(line))
+                else:
+                    self.stdout.write(line)
+
+            mark_paid(paid_ids)
+            for i in range(0, len(unpaid_ids), 500):
+                BonusPayment.objects.filter(id__in = unpaid_ids[i:i + 500]).update(may_be_paid = False)
+            self.num_paid += len(paid_ids)
+            self.num_checked += len(paid_ids) + len(unpaid_ids)
+            self.num_reads += num_reads
+
+LIST_BONUS_PAYMENTS_LIMIT = 100 # most results ListBonusPayments returns at once
+
+def list_bonus_payments(mturk_client, **params):
+    """
+    Yields each page of ListBonusPayments for a HITId or an AssignmentId
+    """
+    while True:
+        response = mturk_client.list_bonus_payments(MaxResults = LIST_BONUS_PAYMENTS_LIMIT, **params)
+        yield response
+        if len(response['BonusPayments']) == 0 or 'NextToken' not in response:
+            return
+        params['NextToken'] = response['NextToken']
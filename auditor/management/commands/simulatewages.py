@@ -0,0 +1,150 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+import numpy as np
+import csv
+import json
+from datetime import timedelta
+
+from auditor.models import AssignmentAudit
+
+"""
+Estimates what the bonuses would have been under other minimum wages, without running
+auditpayments. The estimated rates that the audits already carry don't depend on the wage,
+so the audits are loaded once, grouped by requester, worker, HIT Type and rate, and every
+candidate wage is computed at once with NumPy.
+
+Like payaudits, the bonus to each worker is totaled per requester and rounded up to the cent.
+Frozen audits and audits nobody reported a time for are left out.
+"""
+
+class Command(BaseCommand):
+    help = 'Simulates the total bonuses, underpaid HIT Types and per-requester exposure under candidate minimum wages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wage', type=float, action='append', dest='wages', help='Candidate minimum wage per hour (can be repeated)')
+        parser.add_argument('--range', type=float, nargs=3, metavar=('START', 'STOP', 'STEP'), help='Candidate minimum wages from START up to and including STOP')
+        parser.add_argument('--days', type=int, default=365, help='Only include assignments approved in the last DAYS days')
+        parser.add_argument('--unpaid', action='store_true', help='Only include audits that have not been paid yet')
+        parser.add_argument('--sandbox', action='store_true', help='Simulate sandbox audits instead of production ones')
+        parser.add_argument('--by-requester', action='store_true', help='Also report each requester\'s exposure')
+        parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+
+    def handle(self, *args, **options):
+        wages = list(options['wages'] or [])
+        if options['range'] is not None:
+            start, stop, step = options['range']
+            if step <= 0:
+                raise CommandError('STEP must be positive.')
+            wages.extend(np.arange(start, stop + step / 2, step).round(2))
+        if len(wages) == 0:
+            wages = [float(settings.MINIMUM_WAGE_PER_HOUR)]
+        wages = np.array(sorted(set(wages)), dtype=float)
+
+        audits = AssignmentAudit.objects.filter(is_sandbox = options['sandbox'], frozen = False, estimated_rate__isnull = False, estimated_time__isnull = False)
+        audits = audits.filter(assignment__timestamp__gte = timezone.now() - timedelta(days = options['days']))
+        if options['unpaid']:
+            audits = audits.filter(closed = False)
+
+        results = simulate(audits, wages)
+        if options['format'] == 'json':
+            self.__write_json(results, options['by_requester'])
+        else:
+            self.__write_csv(results, options['by_requester'])
+
+    def __write_csv(self, results, by_requester):
+        # the row with an empty requester is the total for that wage
+        writer = csv.writer(self.stdout, lineterminator = '\n')
+        writer.writerow(['wage', 'requester', 'bonus', 'underpaid_hit_types', 'underpaid_assignments'])
+        for i, wage in enumerate(results['wages']):
+            writer.writerow(['%.2f' % wage, '', '%.2f' % results['bonus'][i], results['underpaid_hit_types'][i], results['underpaid_assignments'][i]])
+            if by_requester:
+                for j, requester_id in enumerate(results['requesters']):
+                    writer.writerow(['%.2f' % wage, requester_id, '%.2f' % results['requester_bonus'][j, i], results['requester_underpaid_hit_types'][j, i], results['requester_underpaid_assignments'][j, i]])
+
+    def __write_json(self, results, by_requester):
+        scenarios = []
+        for i, wage in enumerate(results['wages']):
+            scenario = {
+                'wage': round(float(wage), 2),
+                'bonus': round(float(results['bonus'][i]), 2),
+                'underpaid_hit_types': int(results['underpaid_hit_types'][i]),
+                'underpaid_assignments': int(results['underpaid_assignments'][i]),
+            }
+            if by_requester:
+                scenario['requesters'] = dict((requester_id, {
+                    'bonus': round(float(results['requester_bonus'][j, i]), 2),
+                    'underpaid_hit_types': int(results['requester_underpaid_hit_types'][j, i]),
+                    'underpaid_assignments': int(results['requester_underpaid_assignments'][j, i]),
+                }) for j, requester_id in enumerate(results['requesters']))
+            scenarios.append(scenario)
+        self.stdout.write(json.dumps(scenarios, indent = 2))
+
+
+def simulate(audits, wages):
+    """
+    Returns the bonuses, underpaid HIT Types and underpaid assignments for each wage in wages,
+    in total and per requester. Arrays are indexed [wage] or [requester, wage].
+    """
+    rows = audits.order_by().values_list('requester_id', 'assignment__worker_id', 'hit_type_id', 'payment', 'estimated_rate').annotate(num_assignments = Count('id'))
+    requester_ids, worker_keys, hit_type_ids, payments, rates, counts = [], [], [], [], [], []
+    for requester_id, worker_id, hit_type_id, payment, rate, num_assignments in rows:
+        requester_ids.append(requester_id)
+        worker_keys.append((requester_id, worker_id))
+        hit_type_ids.append(hit_type_id)
+        payments.append(float(payment))
+        rates.append(float(rate))
+        counts.append(num_assignments)
+
+    requesters, row_requester = np.unique(np.array(requester_ids, dtype=object), return_inverse = True)
+    workers = dict((key, i) for i, key in enumerate(sorted(set(worker_keys))))
+    row_worker = np.array([workers[key] for key in worker_keys], dtype=int)
+    worker_requester = np.zeros(len(workers), dtype=int)
+    worker_requester[row_worker] = row_requester
+    hit_types, row_hit_type = np.unique(np.array(hit_type_ids, dtype=object), return_inverse = True)
+    hit_type_requester = np.zeros(len(hit_types), dtype=int)
+    hit_type_requester[row_hit_type] = row_requester
+
+    payments = np.array(payments, dtype=float)[:, None]
+    rates = np.array(rates, dtype=float)[:, None]
+    counts = np.array(counts, dtype=int)[:, None]
+
+    # rows x wages: what each group of assignments is owed under each wage
+    underpaid = rates < wages[None, :]
+    bonus = np.where(underpaid, counts * payments * (wages[None, :] / rates - 1), 0)
+
+    # each worker gets one bonus per requester, rounded up to the cent (after dropping float noise, like get_underpayment)
+    worker_bonus = group_sum(bonus, row_worker, len(workers))
+    worker_bonus = np.ceil(np.round(worker_bonus * 100, 4)) / 100
+    requester_bonus = group_sum(worker_bonus, worker_requester, len(requesters))
+
+    hit_type_underpaid = group_sum(underpaid.astype(int), row_hit_type, len(hit_types)) > 0
+    requester_underpaid_hit_types = group_sum(hit_type_underpaid.astype(int), hit_type_requester, len(requesters))
+    requester_underpaid_assignments = group_sum(counts * underpaid, row_requester, len(requesters))
+
+    return {
+        'wages': wages,
+        'requesters': list(requesters),
+        'bonus': requester_bonus.sum(axis = 0),
+        'underpaid_hit_types': requester_underpaid_hit_types.sum(axis = 0),
+        'underpaid_assignments': requester_underpaid_assignments.sum(axis = 0),
+        'requester_bonus': requester_bonus,
+        'requester_underpaid_hit_types': requester_underpaid_hit_types,
+        'requester_underpaid_assignments': requester_underpaid_assignments,
+    }
+
+def group_sum(values, groups, num_groups):
+    """
+    Sums the rows of values that share a group: result[g] = values[groups == g].sum(axis=0).
+    Same as np.add.at, which is much slower on large arrays.
+    """
+    result = np.zeros((num_groups,) + values.shape[1:], dtype=values.dtype)
+    if len(groups) == 0:
+        return result
+    order = np.argsort(groups, kind='mergesort')
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_groups[1:] != sorted_groups[:-1])))
+    result[sorted_groups[starts]] = np.add.reduceat(values[order], starts, axis = 0)
+    return result
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.5 on 2026-10-18 10:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auditor', '0019_auto_20190516_1222'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hit',
+            name='assignment_duration_seconds',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
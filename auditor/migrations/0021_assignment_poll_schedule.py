@@ -0,0 +1,32 @@
+# Generated by Django 2.0.5 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auditor', '0020_hit_assignment_duration_seconds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignment',
+            name='next_poll_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='assignment',
+            name='poll_backoff',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='hit',
+            name='auto_approval_delay_seconds',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='assignment',
+            index=models.Index(fields=['status', 'next_poll_at'], name='auditor_assignment_poll_idx'),
+        ),
+    ]
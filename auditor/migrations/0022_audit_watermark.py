@@ -0,0 +1,26 @@
+# Generated by Django 2.0.5 on 2026-10-18 11:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auditor', '0021_assignment_poll_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_sandbox', models.BooleanField(unique=True)),
+                ('timestamp', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='hittype',
+            name='changed',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 2.0.5 on 2026-10-18 11:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from auditor.summaries import pack, sorted_median, to_microseconds
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auditor', '0022_audit_watermark'),
+    ]
+
+    def summarize_durations(apps, schema_editor):
+        AssignmentDuration = apps.get_model('auditor', 'AssignmentDuration')
+        RequesterFreeze = apps.get_model('auditor', 'RequesterFreeze')
+        HITDurationSummary = apps.get_model('auditor', 'HITDurationSummary')
+        HITTypeDurationSummary = apps.get_model('auditor', 'HITTypeDurationSummary')
+
+        hit_durations = dict()
+        hit_types = dict()
+        frozen = set(RequesterFreeze.objects.values_list('requester_id', 'worker_id'))
+        for hit_id, hit_type_id, requester_id, worker_id, duration in AssignmentDuration.objects.values_list('assignment__hit_id', 'assignment__hit__hit_type_id', 'assignment__hit__hit_type__requester_id', 'assignment__worker_id', 'duration').iterator():
+            if (requester_id, worker_id) not in frozen:
+                hit_durations.setdefault(hit_id, []).append(to_microseconds(duration))
+                hit_types[hit_id] = hit_type_id
+
+        hit_type_medians = dict()
+        summaries = []
+        for hit_id, durations in hit_durations.items():
+            durations.sort()
+            summaries.append(HITDurationSummary(hit_id = hit_id, durations = pack(durations), count = len(durations), median = sorted_median(durations)))
+            hit_type_medians.setdefault(hit_types[hit_id], []).append(to_microseconds(summaries[-1].median))
+        HITDurationSummary.objects.bulk_create(summaries, batch_size = 500)
+
+        summaries = []
+        for hit_type_id, medians in hit_type_medians.items():
+            medians.sort()
+            summaries.append(HITTypeDurationSummary(hit_type_id = hit_type_id, medians = pack(medians), count = len(medians), median = sorted_median(medians)))
+        HITTypeDurationSummary.objects.bulk_create(summaries, batch_size = 500)
+
+    operations = [
+        migrations.CreateModel(
+            name='HITDurationSummary',
+            fields=[
+                ('hit', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='auditor.HIT')),
+                ('durations', models.BinaryField(default=b'')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('median', models.DurationField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HITTypeDurationSummary',
+            fields=[
+                ('hit_type', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='auditor.HITType')),
+                ('medians', models.BinaryField(default=b'')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('median', models.DurationField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(summarize_durations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 2.0.5 on 2026-10-18 11:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auditor', '0023_duration_summaries'),
+    ]
+
+    def snapshot_hit_types(apps, schema_editor):
+        HITType = apps.get_model('auditor', 'HITType')
+        AssignmentAudit = apps.get_model('auditor', 'AssignmentAudit')
+        for hit_type in HITType.objects.all():
+            AssignmentAudit.objects.filter(assignment__hit__hit_type = hit_type).update(
+                payment = hit_type.payment,
+                requester_id = hit_type.requester_id,
+                hit_type_id = hit_type.id,
+                is_sandbox = 'sandbox' in hit_type.host
+            )
+
+    operations = [
+        migrations.AddField(
+            model_name='assignmentaudit',
+            name='hit_type',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='auditor.HITType'),
+        ),
+        migrations.AddField(
+            model_name='assignmentaudit',
+            name='is_sandbox',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='assignmentaudit',
+            name='payment',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='assignmentaudit',
+            name='requester',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='auditor.Requester'),
+        ),
+        migrations.RunPython(snapshot_hit_types, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='assignmentaudit',
+            index=models.Index(fields=['requester', 'closed', 'needsPayment', 'message_sent'], name='auditor_audit_requester_idx'),
+        ),
+    ]
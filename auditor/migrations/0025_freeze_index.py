@@ -0,0 +1,27 @@
+# Generated by Django 2.0.5 on 2026-10-18 11:39
+
+from django.db import migrations
+from django.db.models import Count
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auditor', '0024_audit_snapshot'),
+    ]
+
+    def remove_duplicate_freezes(apps, schema_editor):
+        # freezing a worker twice used to add a second row; keep the latest reason
+        RequesterFreeze = apps.get_model('auditor', 'RequesterFreeze')
+        duplicates = RequesterFreeze.objects.values('requester_id', 'worker_id').annotate(num_freezes = Count('id')).filter(num_freezes__gt = 1)
+        for duplicate in duplicates:
+            freezes = RequesterFreeze.objects.filter(requester_id = duplicate['requester_id'], worker_id = duplicate['worker_id']).order_by('-timestamp', '-id')
+            RequesterFreeze.objects.filter(id__in = list(freezes.values_list('id', flat = True)[1:])).delete()
+
+    operations = [
+        migrations.RunPython(remove_duplicate_freezes, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='requesterfreeze',
+            unique_together={('requester', 'worker')},
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.0.5 on 2026-10-18 11:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auditor', '0025_freeze_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BonusPayment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=255, unique=True)),
+                ('is_sandbox', models.BooleanField(default=False)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('reason', models.TextField()),
+                ('status', models.CharField(choices=[('p', 'pending'), ('u', 'requester out of funds'), ('d', 'paid'), ('f', 'failed'), ('c', 'cancelled')], default='p', max_length=1)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('next_attempt_at', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('timestamp', models.DateTimeField(auto_now=True)),
+                ('assignment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auditor.Assignment')),
+                ('requester', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auditor.Requester')),
+                ('worker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auditor.Worker')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='assignmentaudit',
+            name='bonus',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='audits', to='auditor.BonusPayment'),
+        ),
+        migrations.AddIndex(
+            model_name='bonuspayment',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='auditor_bonus_due_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.5 on 2026-10-18 12:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auditor', '0026_bonus_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bonuspayment',
+            name='may_be_paid',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -19,6 +19,8 @@ class HITType(models.Model):
     payment = models.DecimalField(max_digits=6, decimal_places=2)
     host = models.CharField(max_length=200) # sandbox or not?
     requester = models.ForeignKey(Requester, on_delete=models.CASCADE)
+    # last time a report, an assignment status or a freeze changed in a way that could change this HIT Type's audit
+    changed = models.DateTimeField(blank=True, null=True, db_index=True)
 
     def is_sandbox(self):
         return "sandbox" in self.host
@@ -29,6 +31,8 @@ class HITType(models.Model):
 class HIT(models.Model):
     id = models.CharField(max_length=200, primary_key=True)
     hit_type = models.ForeignKey(HITType, on_delete=models.CASCADE)
+    assignment_duration_seconds = models.PositiveIntegerField(blank=True, null=True) # AssignmentDurationInSeconds on AMT, filled in the first time we look it up
+    auto_approval_delay_seconds = models.PositiveIntegerField(blank=True, null=True) # AutoApprovalDelayInSeconds on AMT, same
 
     def __str__(self):
         return self.id
@@ -46,6 +50,9 @@ class RequesterFreeze(models.Model):
     timestamp = models.DateTimeField(auto_now=True)
     reason = models.TextField()
 
+    class Meta:
+        unique_together = ('requester', 'worker')
+
 class Assignment(models.Model):
     id = models.CharField(max_length=200, primary_key=True)
     hit = models.ForeignKey(HIT, on_delete=models.CASCADE)
@@ -68,6 +75,16 @@ class Assignment(models.Model):
     status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=OPEN)
     timestamp = models.DateTimeField(auto_now=True)
 
+    # pullnotifications only checks an open or submitted assignment once next_poll_at has passed (or was never set),
+    # and waits longer each time it finds nothing new
+    next_poll_at = models.DateTimeField(blank=True, null=True)
+    poll_backoff = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_poll_at'], name='auditor_assignment_poll_idx'),
+        ]
+
     def __str__(self):
         return self.id
 
@@ -80,6 +97,27 @@ class AssignmentDuration(models.Model):
     def __str__(self):
         return "%s: %s" % (self.assignment, self.duration)
 
+class HITDurationSummary(models.Model):
+    # The HIT's duration reports, leaving out workers frozen by its requester, so audits read
+    # the median instead of recomputing it. Kept up to date by auditor.summaries.
+    hit = models.OneToOneField(HIT, on_delete=models.CASCADE, primary_key=True)
+    durations = models.BinaryField(default=b'') # sorted, in microseconds, packed as 8-byte integers
+    count = models.PositiveIntegerField(default=0)
+    median = models.DurationField(blank=True, null=True)
+
+    def __str__(self):
+        return "%s: median %s of %d" % (self.hit_id, self.median, self.count)
+
+class HITTypeDurationSummary(models.Model):
+    # The medians of the HIT Type's HITs that have at least one report, and the median of those
+    hit_type = models.OneToOneField(HITType, on_delete=models.CASCADE, primary_key=True)
+    medians = models.BinaryField(default=b'') # sorted, in microseconds, packed as 8-byte integers
+    count = models.PositiveIntegerField(default=0)
+    median = models.DurationField(blank=True, null=True)
+
+    def __str__(self):
+        return "%s: median %s of %d" % (self.hit_type_id, self.median, self.count)
+
 class AssignmentAudit(models.Model):
     assignment = models.OneToOneField(Assignment, on_delete=models.CASCADE)
     estimated_time = models.DurationField(blank=True, null=True)
@@ -105,6 +143,32 @@ class AssignmentAudit(models.Model):
     message_sent = models.DateTimeField(blank=True, null=True)
     timestamp = models.DateTimeField(auto_now=True)
 
+    # Copied from the assignment's HIT Type when the audit is written, so that paying and
+    # notifying don't have to join through Assignment, HIT and HITType
+    payment = models.DecimalField(max_digits=6, decimal_places=2, blank=True, null=True)
+    requester = models.ForeignKey(Requester, on_delete=models.CASCADE, blank=True, null=True)
+    hit_type = models.ForeignKey(HITType, on_delete=models.CASCADE, blank=True, null=True)
+    is_sandbox = models.BooleanField(default = False)
+
+    # the queued bonus that pays this audit, set by payaudits
+    bonus = models.ForeignKey('BonusPayment', on_delete=models.SET_NULL, blank=True, null=True, related_name='audits')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['requester', 'closed', 'needsPayment', 'message_sent'], name='auditor_audit_requester_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.hit_type_id is None:
+            self.set_hit_type(self.assignment.hit.hit_type)
+        super(AssignmentAudit, self).save(*args, **kwargs)
+
+    def set_hit_type(self, hit_type):
+        self.payment = hit_type.payment
+        self.requester_id = hit_type.requester_id
+        self.hit_type_id = hit_type.id
+        self.is_sandbox = hit_type.is_sandbox()
+
     # We need to ensure that the estimated_rate didn't get rounded to $0/hr, which presents problems later
     def clean(self):
         super(AssignmentAudit, self).clean()
@@ -129,12 +193,12 @@ class AssignmentAudit(models.Model):
             return Decimal('0.00') # no bonus necessary
 
         underpayment_ratio = settings.MINIMUM_WAGE_PER_HOUR / self.estimated_rate
-        paid_already = self.assignment.hit.hit_type.payment
+        paid_already = self.payment
         underpayment = paid_already * (underpayment_ratio - 1)
         return underpayment
 
     def __str__(self):
-        s = '%s:\n\tBase pay to %s: $%.2f\n\t' % (self.assignment, self.assignment.worker, self.assignment.hit.hit_type.payment)
+        s = '%s:\n\tBase pay to %s: $%.2f\n\t' % (self.assignment, self.assignment.worker, self.payment)
         if self.estimated_time is None or self.estimated_rate is None:
             s += 'Effective time and rate unknown'
         else:
@@ -144,4 +208,56 @@ class AssignmentAudit(models.Model):
                 s += 'Need to multiply base pay by %.2fx to reach $%.2f/hr\n\tBonus $%.2f' % (underpayment_ratio, settings.MINIMUM_WAGE_PER_HOUR, self.get_underpayment())
             else:
                 s += 'Met or exceeded target rate of $%.2f/hr' % (settings.MINIMUM_WAGE_PER_HOUR)
-        return s
\ No newline at end of file
+        return s
+
+class AuditWatermark(models.Model):
+    # auditpayments only re-audits HIT Types that changed since its last run started
+    is_sandbox = models.BooleanField(unique=True)
+    timestamp = models.DateTimeField()
+
+    def __str__(self):
+        return '%s: %s' % ('sandbox' if self.is_sandbox else 'production', self.timestamp)
+
+class BonusPayment(models.Model):
+    # One bonus that payaudits decided to send, covering all of a worker's audits for a requester.
+    # drainbonuses sends it, and keeps retrying with backoff until MTurk accepts it.
+    PENDING = 'p'
+    UNFUNDED = 'u'
+    PAID = 'd'
+    FAILED = 'f'
+    CANCELLED = 'c'
+    STATUS_CHOICES = (
+        (PENDING, 'pending'),
+        (UNFUNDED, 'requester out of funds'),
+        (PAID, 'paid'),
+        (FAILED, 'failed'),
+        (CANCELLED, 'cancelled')
+    )
+    # statuses that drainbonuses still tries to send
+    OPEN_STATUSES = (PENDING, UNFUNDED)
+
+    token = models.CharField(max_length=255, unique=True) # UniqueRequestToken, so MTurk never sends the same bonus twice
+    requester = models.ForeignKey(Requester, on_delete=models.CASCADE)
+    worker = models.ForeignKey(Worker, on_delete=models.CASCADE)
+    assignment = models.ForeignKey(Assignment, on_delete=models.CASCADE) # MTurk attaches a bonus to one assignment
+    is_sandbox = models.BooleanField(default = False)
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    reason = models.TextField()
+
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+    # set while MTurk may have accepted the bonus without our knowing: from just before drainbonuses sends it
+    # until MTurk's answer says otherwise. Until then it must not be cancelled, or its audits moved to another bonus.
+    may_be_paid = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='auditor_bonus_due_idx'),
+        ]
+
+    def __str__(self):
+        return '%s: $%.2f to %s (%s)' % (self.token, self.amount, self.worker_id, self.get_status_display())
@@ -0,0 +1,212 @@
+from django.conf import settings
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from botocore.retryhandler import EXCEPTION_MAP
+
+from collections import OrderedDict
+import hashlib
+import random
+import threading
+import time
+
+"""
+Hands out boto3 MTurk clients. Clients are built lazily, once per process for each
+AWS account, host and set of credentials, and kept in a pool with LRU eviction.
+They are wrapped so that everything calling MTurk shares one rate limit per
+AWS account and host, and retries throttled calls, server errors and dropped connections
+with jittered exponential backoff. botocore's own retries are turned off, so they don't
+multiply these.
+
+Settings (all optional):
+- MTURK_CLIENT_POOL_SIZE: clients kept in the pool before the least recently used is dropped (default 100)
+- MTURK_RATE_LIMIT: sustained calls per second, per account and host (default 5)
+- MTURK_RATE_BURST: calls that may be made at once before the rate limit applies (default 10)
+- MTURK_MAX_RETRIES: retries of a single failed call (default 5)
+- MTURK_RETRY_BASE_DELAY, MTURK_RETRY_MAX_DELAY: bounds on the backoff, in seconds (default 0.5 and 20)
+- MTURK_RETRY_BUDGET_RATIO: retries earned by each successful call, process-wide (default 0.1)
+- MTURK_RETRY_BUDGET: most retries that can be banked, and the number available at start (default 10)
+"""
+
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded')
+
+# what a call raises when MTurk's answer never arrived: the same errors botocore retries on
+CONNECTION_ERRORS = tuple(EXCEPTION_MAP['GENERAL_CONNECTION_ERROR'])
+# everything a call can fail with that's MTurk's or the network's doing, rather than ours:
+# callers skip the item the call was for, and carry on with the rest
+MTURK_ERRORS = (ClientError,) + CONNECTION_ERRORS
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average, and bursts of up to `capacity` calls
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # take the token now, even if that puts us in debt, so waiting callers queue up fairly
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class RetryBudget:
+    """
+    Caps retries at a fraction of successful calls, so that when MTurk is throttling
+    everybody we back off instead of multiplying our own traffic
+    """
+    def __init__(self, ratio, capacity):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.balance = capacity
+        self.lock = threading.Lock()
+
+    def record_success(self):
+        with self.lock:
+            self.balance = min(self.balance + self.ratio, self.capacity)
+
+    def try_spend(self):
+        with self.lock:
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            return False
+
+class ThrottledClient:
+    """
+    Stands in for a boto3 MTurk client. API calls wait for the account's rate limit
+    and are retried if throttled, if MTurk fails or if the connection drops;
+    everything else (e.g., .exceptions) passes through.
+    """
+    def __init__(self, client, bucket):
+        self._client = client
+        self._bucket = bucket
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self._client.meta.method_to_api_mapping:
+            return attr
+
+        def call(*args, **kwargs):
+            return self._call(attr, *args, **kwargs)
+        return call
+
+    def _call(self, method, *args, **kwargs):
+        max_retries = getattr(settings, 'MTURK_MAX_RETRIES', 5)
+        base_delay = getattr(settings, 'MTURK_RETRY_BASE_DELAY', 0.5)
+        max_delay = getattr(settings, 'MTURK_RETRY_MAX_DELAY', 20)
+
+        attempt = 0
+        while True:
+            self._bucket.acquire()
+            try:
+                response = method(*args, **kwargs)
+            except MTURK_ERRORS as e:
+                if not is_retryable_error(e) or attempt >= max_retries or not retry_budget.try_spend():
+                    raise
+                # "full jitter": spreads the retries of many callers throttled at the same moment
+                time.sleep(random.uniform(0, min(max_delay, base_delay * (2 ** attempt))))
+                attempt += 1
+            else:
+                retry_budget.record_success()
+                return response
+
+def is_retryable_error(e):
+    if isinstance(e, CONNECTION_ERRORS):
+        return True
+    # as botocore would: a 5xx means MTurk failed, not that the request was wrong
+    return is_throttling_error(e) or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+def is_throttling_error(e):
+    error = e.response.get('Error', {})
+    if error.get('Code') in THROTTLING_ERROR_CODES:
+        return True
+    message = error.get('Message', '').lower()
+    return 'rate exceeded' in message or 'maximum request rate' in message
+
+def get_mturk_client(requester, is_sandbox):
+    return get_mturk_connection(requester)['sandbox' if is_sandbox else 'production']
+
+def get_mturk_connection(requester):
+    """
+    Returns {'production': client, 'sandbox': client} for the requester. Each client
+    is only built (or taken from the pool) the first time it's looked up.
+    """
+    return MTurkConnection(requester)
+
+class MTurkConnection:
+    def __init__(self, requester):
+        self.requester = requester
+
+    def __getitem__(self, name):
+        if name == 'sandbox':
+            host = settings.MTURK_SANDBOX_ENDPOINT
+        elif name == 'production':
+            host = settings.MTURK_ENDPOINT
+        else:
+            raise KeyError(name)
+        return client_pool.get(self.requester, host)
+
+class ClientPool:
+    """
+    Process-wide, thread-safe pool of wrapped clients keyed by (aws_account, host, credentials fingerprint),
+    so rotated keys never reuse a client built with the old ones
+    """
+    def __init__(self, size):
+        self.size = size
+        self.clients = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, requester, host):
+        key = (requester.aws_account, host, credentials_fingerprint(requester.key, requester.secret))
+        with self.lock:
+            if key in self.clients:
+                self.clients.move_to_end(key)
+                return self.clients[key]
+
+        # build outside the lock, since it's slow (it loads the service model), on a session of its own:
+        # boto3's default session is not thread-safe
+        client = boto3.session.Session().client('mturk',
+            aws_access_key_id = requester.key,
+            aws_secret_access_key = requester.secret,
+            region_name = 'us-east-1',
+            endpoint_url = host,
+            # retries happen in ThrottledClient, which shares a rate limit and retry budget across clients
+            config = Config(retries = {'max_attempts': 0})
+        )
+        client = ThrottledClient(client, get_bucket(requester.aws_account, host))
+
+        with self.lock:
+            client = self.clients.setdefault(key, client)
+            self.clients.move_to_end(key)
+            while len(self.clients) > self.size:
+                self.clients.popitem(last = False)
+        return client
+
+    def invalidate(self, aws_account):
+        with self.lock:
+            for key in [key for key in self.clients if key[0] == aws_account]:
+                del self.clients[key]
+
+def credentials_fingerprint(key, secret):
+    return hashlib.sha256(('%s:%s' % (key, secret)).encode('utf-8')).hexdigest()[:16]
+
+def get_bucket(aws_account, host):
+    with _buckets_lock:
+        if (aws_account, host) not in _buckets:
+            _buckets[(aws_account, host)] = TokenBucket(getattr(settings, 'MTURK_RATE_LIMIT', 5), getattr(settings, 'MTURK_RATE_BURST', 10))
+        return _buckets[(aws_account, host)]
+
+_buckets = dict()
+_buckets_lock = threading.Lock()
+retry_budget = RetryBudget(getattr(settings, 'MTURK_RETRY_BUDGET_RATIO', 0.1), getattr(settings, 'MTURK_RETRY_BUDGET', 10))
+client_pool = ClientPool(getattr(settings, 'MTURK_CLIENT_POOL_SIZE', 100))
@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+import boto3
+import os
+import time
+
+"""
+Queues that MTurk assignment notifications are read from. Configure one with, e.g.:
+
+MTURK_NOTIFICATION_QUEUE = {
+    'BACKEND': 'auditor.queues.SQSQueue',
+    'OPTIONS': {'queue_url': 'https://sqs.us-east-1.amazonaws.com/123456789012/fairwork'},
+}
+
+A backend needs two methods: receive(max_messages, wait_seconds), which returns a list of
+(handle, body) pairs, and delete(handles), which acknowledges messages once they are processed.
+Messages that are never deleted are delivered again later.
+"""
+
+def get_notification_queue():
+    config = getattr(settings, 'MTURK_NOTIFICATION_QUEUE', None)
+    if config is None:
+        raise ImproperlyConfigured('MTURK_NOTIFICATION_QUEUE is not set.')
+    backend = import_string(config['BACKEND'])
+    return backend(**config.get('OPTIONS', {}))
+
+class SQSQueue:
+    """
+    The Amazon SQS queue that MTurk publishes notifications to
+    """
+    MAX_BATCH = 10 # SQS receives and deletes at most 10 messages per call
+
+    def __init__(self, queue_url, region_name = 'us-east-1', aws_access_key_id = None, aws_secret_access_key = None):
+        self.queue_url = queue_url
+        self.client = boto3.client('sqs',
+            region_name = region_name,
+            aws_access_key_id = aws_access_key_id,
+            aws_secret_access_key = aws_secret_access_key
+        )
+
+    def receive(self, max_messages, wait_seconds):
+        response = self.client.receive_message(
+            QueueUrl = self.queue_url,
+            MaxNumberOfMessages = max(1, min(max_messages, self.MAX_BATCH)),
+            WaitTimeSeconds = wait_seconds
+        )
+        return [(message['ReceiptHandle'], message['Body']) for message in response.get('Messages', [])]
+
+    def delete(self, handles):
+        for i in range(0, len(handles), self.MAX_BATCH):
+            entries = [{'Id': str(n), 'ReceiptHandle': handle} for n, handle in enumerate(handles[i:i + self.MAX_BATCH])]
+            self.client.delete_message_batch(QueueUrl = self.queue_url, Entries = entries)
+
+class FileQueue:
+    """
+    A local stand-in for SQS: every *.json file in a directory is one message,
+    read in filename order and removed when it's deleted. Meant for development
+    and tests, with a single consumer.
+    """
+    POLL_INTERVAL = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.in_flight = set() # received but not yet deleted, so not handed out again
+
+    def receive(self, max_messages, wait_seconds):
+        deadline = time.time() + wait_seconds
+        while True:
+            filenames = sorted(f for f in os.listdir(self.path) if f.endswith('.json') and f not in self.in_flight)[:max_messages]
+            if filenames or time.time() >= deadline:
+                break
+            time.sleep(self.POLL_INTERVAL)
+
+        messages = []
+        for filename in filenames:
+            with open(os.path.join(self.path, filename)) as f:
+                messages.append((filename, f.read()))
+            self.in_flight.add(filename)
+        return messages
+
+    def delete(self, handles):
+        for filename in handles:
+            self.in_flight.discard(filename)
+            try:
+                os.remove(os.path.join(self.path, filename))
+            except FileNotFoundError:
+                pass
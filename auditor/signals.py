@@ -0,0 +1,58 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import HITType, HIT, Assignment, AssignmentDuration, RequesterFreeze
+from .summaries import update_hit_summary, rebuild_summaries
+from .freezes import invalidate_frozen_workers
+
+"""
+Marks HIT Types as changed whenever something that feeds their audit changes,
+so auditpayments can skip the ones that haven't, and keeps the duration summaries
+(see auditor.summaries) and the frozen-worker cache (see auditor.freezes) in step
+with the reports and freezes. Bulk updates don't send signals:
+code that changes these models with update() calls mark_changed itself.
+"""
+
+def mark_changed(hit_types):
+    hit_types.update(changed = timezone.now())
+
+@receiver(post_save, sender=AssignmentDuration)
+@receiver(post_delete, sender=AssignmentDuration)
+def duration_changed(sender, instance, **kwargs):
+    mark_changed(HITType.objects.filter(hit__assignment__id = instance.assignment_id))
+
+@receiver(pre_save, sender=AssignmentDuration)
+def remember_duration(sender, instance, **kwargs):
+    # the summary needs the old report to take it out
+    instance._old_duration = AssignmentDuration.objects.filter(pk = instance.pk).values_list('duration', flat = True).first() if instance.pk else None
+
+@receiver(post_save, sender=AssignmentDuration)
+def duration_saved(sender, instance, **kwargs):
+    old_duration = getattr(instance, '_old_duration', None)
+    summarize_duration(instance, [old_duration] if old_duration is not None else [], [instance.duration])
+
+@receiver(post_delete, sender=AssignmentDuration)
+def duration_deleted(sender, instance, **kwargs):
+    summarize_duration(instance, [instance.duration], [])
+
+def summarize_duration(duration, removed, added):
+    assignment = Assignment.objects.filter(id = duration.assignment_id).values_list('hit_id', 'hit__hit_type_id', 'hit__hit_type__requester_id', 'worker_id').first()
+    if assignment is None:
+        return
+    hit_id, hit_type_id, requester_id, worker_id = assignment
+    # straight from the database rather than auditor.freezes: a stale cache entry here would stick in the summary
+    if RequesterFreeze.objects.filter(requester_id = requester_id, worker_id = worker_id).exists():
+        return # frozen workers' reports aren't counted
+    update_hit_summary(hit_id, hit_type_id, removed, added)
+
+@receiver(post_save, sender=Assignment)
+def assignment_changed(sender, instance, **kwargs):
+    mark_changed(HITType.objects.filter(hit__id = instance.hit_id))
+
+@receiver(post_save, sender=RequesterFreeze)
+@receiver(post_delete, sender=RequesterFreeze)
+def freeze_changed(sender, instance, **kwargs):
+    invalidate_frozen_workers(instance.requester_id)
+    mark_changed(HITType.objects.filter(requester_id = instance.requester_id, hit__assignment__worker_id = instance.worker_id))
+    rebuild_summaries(HIT.objects.filter(hit_type__requester_id = instance.requester_id, assignment__worker_id = instance.worker_id))
@@ -0,0 +1,109 @@
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from bisect import bisect_left, insort
+from datetime import timedelta
+import itertools
+import struct
+
+from .models import HIT, AssignmentDuration, RequesterFreeze, HITDurationSummary, HITTypeDurationSummary
+
+"""
+Keeps the median duration report of every HIT, and the median of those medians for every
+HIT Type, up to date as reports come in, so audits never scan the raw reports. Each summary
+holds its values as a sorted array, so a report is added or removed with a binary search
+and the median is read straight from the middle.
+
+Reports from a worker that the HIT's requester has frozen are left out. A freeze or an
+unfreeze rebuilds the summaries of the HITs the worker reported on.
+"""
+
+def update_hit_summary(hit_id, hit_type_id, removed = (), added = ()):
+    """
+    Takes the removed durations out of the HIT's summary and adds the added ones, then
+    passes any change in the HIT's median on to its HIT Type's summary
+    """
+    with transaction.atomic():
+        if len(added) > 0:
+            summary, created = HITDurationSummary.objects.select_for_update().get_or_create(hit_id = hit_id)
+        else:
+            # nothing to take out of a summary that doesn't exist, e.g., when the HIT itself is being deleted
+            summary = HITDurationSummary.objects.select_for_update().filter(hit_id = hit_id).first()
+            if summary is None:
+                return
+        old_median = summary.median
+        durations = update_sorted(unpack(summary.durations), removed, added)
+        summary.durations = pack(durations)
+        summary.count = len(durations)
+        summary.median = sorted_median(durations)
+        summary.save()
+
+        if summary.median != old_median:
+            update_hit_type_summary(hit_type_id, [old_median] if old_median is not None else [], [summary.median] if summary.median is not None else [])
+
+def update_hit_type_summary(hit_type_id, removed = (), added = ()):
+    with transaction.atomic():
+        summary, created = HITTypeDurationSummary.objects.select_for_update().get_or_create(hit_type_id = hit_type_id)
+        medians = update_sorted(unpack(summary.medians), removed, added)
+        summary.medians = pack(medians)
+        summary.count = len(medians)
+        summary.median = sorted_median(medians)
+        summary.save()
+
+def rebuild_summaries(hits):
+    """
+    Recomputes the summaries of the given HITs, and of their HIT Types, from the reports themselves
+    """
+    frozen = RequesterFreeze.objects.filter(requester_id = OuterRef('assignment__hit__hit_type__requester_id'), worker_id = OuterRef('assignment__worker_id'))
+    reports = AssignmentDuration.objects.filter(assignment__hit__in = hits).annotate(worker_frozen = Exists(frozen)).filter(worker_frozen = False)
+    reports = reports.order_by('assignment__hit_id').values_list('assignment__hit_id', 'duration')
+
+    with transaction.atomic():
+        hit_ids = list(hits.values_list('id', flat = True).distinct())
+        hit_type_ids = set(HIT.objects.filter(id__in = hit_ids).values_list('hit_type_id', flat = True))
+        HITDurationSummary.objects.filter(hit_id__in = hit_ids).delete()
+
+        summaries = []
+        for hit_id, hit_reports in itertools.groupby(reports.iterator(), key = lambda report: report[0]):
+            durations = sorted(to_microseconds(report[1]) for report in hit_reports)
+            summaries.append(HITDurationSummary(hit_id = hit_id, durations = pack(durations), count = len(durations), median = sorted_median(durations)))
+        HITDurationSummary.objects.bulk_create(summaries, batch_size = 500)
+
+        # a HIT Type's summary covers all of its HITs, not just the rebuilt ones
+        HITTypeDurationSummary.objects.filter(hit_type_id__in = hit_type_ids).delete()
+        hit_medians = HITDurationSummary.objects.filter(hit__hit_type_id__in = hit_type_ids, count__gt = 0).order_by('hit__hit_type_id').values_list('hit__hit_type_id', 'median')
+        summaries = []
+        for hit_type_id, hit_type_medians in itertools.groupby(hit_medians.iterator(), key = lambda hit_median: hit_median[0]):
+            medians = sorted(to_microseconds(hit_median[1]) for hit_median in hit_type_medians)
+            summaries.append(HITTypeDurationSummary(hit_type_id = hit_type_id, medians = pack(medians), count = len(medians), median = sorted_median(medians)))
+        HITTypeDurationSummary.objects.bulk_create(summaries, batch_size = 500)
+
+def update_sorted(values, removed, added):
+    for duration in removed:
+        value = to_microseconds(duration)
+        i = bisect_left(values, value)
+        if i < len(values) and values[i] == value:
+            del values[i]
+    for duration in added:
+        insort(values, to_microseconds(duration))
+    return values
+
+def sorted_median(values):
+    # matches statistics.median on the timedeltas, rounding included
+    n = len(values)
+    if n == 0:
+        return None
+    elif n % 2 == 1:
+        return timedelta(microseconds = values[n // 2])
+    else:
+        return (timedelta(microseconds = values[n // 2 - 1]) + timedelta(microseconds = values[n // 2])) / 2
+
+def to_microseconds(duration):
+    return (duration.days * 24 * 60 * 60 + duration.seconds) * 1000000 + duration.microseconds
+
+def pack(values):
+    return struct.pack('<%dq' % len(values), *values)
+
+def unpack(data):
+    data = bytes(data) # PostgreSQL hands back a memoryview
+    return list(struct.unpack('<%dq' % (len(data) // 8), data))
@@ -1,3 +1,500 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.core import mail
+from django.urls import reverse
+from django.utils import timezone
 
-# Create your tests here.
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from auditor.models import HITType, HIT, Worker, Assignment, AssignmentDuration, AssignmentAudit, Requester, RequesterFreeze, BonusPayment, HITDurationSummary, HITTypeDurationSummary
+from auditor.fakemturk import FakeMTurk, FakeMTurkError, make_server
+from auditor.mturk import ClientPool, get_mturk_client
+from auditor.management.commands import drainbonuses, auditpayments, fakemturk
+from auditor.management.commands.pullnotifications import get_next_poll
+from auditor import views
+
+PRODUCTION_HOST = 'https://www.mturk.com'
+
+class FakeMTurkTestCase(TestCase):
+    """
+    Points both MTurk endpoints at a FakeMTurk served for the length of the test
+    """
+    def setUp(self):
+        self.fake = FakeMTurk()
+        self.server = make_server(self.fake)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        endpoint = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.endpoints = override_settings(MTURK_ENDPOINT = endpoint, MTURK_SANDBOX_ENDPOINT = endpoint, MTURK_RATE_LIMIT = 1000, MTURK_RATE_BURST = 1000)
+        self.endpoints.enable()
+
+    def tearDown(self):
+        self.endpoints.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_assignments(self, num_workers, hit_type_id = 'HT1', requester_id = 'R1', status = Assignment.APPROVED, hits_per_worker = 1):
+        # registered with the fake as approved
+        assignments = create_assignments(num_workers, hit_type_id, requester_id, status, hits_per_worker)
+        for assignment in assignments:
+            self.fake.add_hit(assignment.hit_id, hit_type_id)
+            self.fake.add_assignment(assignment.id, assignment.hit_id, assignment.worker_id, 'Approved')
+        return assignments
+
+    def fail(self, operation, key, failing_id, error, times = None):
+        """
+        Makes the fake's answers to operation for the assignment or HIT failing_id raise error,
+        the first `times` times (every time if None)
+        """
+        op = getattr(self.fake, '_op_%s' % operation)
+        failures = []
+        def failing_op(params, access_key):
+            if params[key] == failing_id and (times is None or len(failures) < times):
+                failures.append(params)
+                raise error
+            return op(params, access_key)
+        return mock.patch.object(self.fake, '_op_%s' % operation, failing_op)
+
+    def drop_connection(self, operation, key, failing_id, times = None):
+        # the fake's server closes the connection without answering, and would print the traceback
+        self.server.handle_error = lambda request, client_address: None
+        return self.fail(operation, key, failing_id, ConnectionResetError('Connection dropped'), times)
+
+    def create_unpaid_audits(self, assignments, estimated_rate = Decimal('5.00')):
+        # past the requester's grace period
+        message_sent = timezone.now() - timedelta(days = 2)
+        return [AssignmentAudit.objects.create(assignment = assignment, estimated_time = timedelta(minutes = 12), estimated_rate = estimated_rate, needsPayment = True, message_sent = message_sent) for assignment in assignments]
+
+def create_assignments(num_workers, hit_type_id = 'HT1', requester_id = 'R1', status = Assignment.APPROVED, hits_per_worker = 1):
+    """
+    One assignment for each of num_workers workers, in HITs of hits_per_worker workers each.
+    Returns the assignments.
+    """
+    requester, created = Requester.objects.get_or_create(aws_account = requester_id, defaults = {'key': 'key-%s' % requester_id, 'secret': 'secret', 'email': '%s@example.com' % requester_id})
+    hit_type, created = HITType.objects.get_or_create(id = hit_type_id, defaults = {'payment': Decimal('1.00'), 'host': PRODUCTION_HOST, 'requester': requester})
+    assignments = []
+    for i in range(num_workers):
+        hit, created = HIT.objects.get_or_create(id = '%s-H%d' % (hit_type_id, i // hits_per_worker), hit_type = hit_type)
+        worker, created = Worker.objects.get_or_create(id = 'W%d' % i)
+        assignments.append(Assignment.objects.create(id = '%s-A%d' % (hit_type_id, i), hit = hit, worker = worker, status = status))
+    return assignments
+
+class CrashingClient:
+    """
+    Passes calls through to an MTurk client, until the crash_at'th SendBonus, which raises
+    as if the connection had dropped: before MTurk gets the call, or with lose_response,
+    after MTurk has paid the bonus
+    """
+    def __init__(self, client, crash_at, lose_response = False):
+        self.client = client
+        self.crash_at = crash_at
+        self.lose_response = lose_response
+        self.num_sent = 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def send_bonus(self, **kwargs):
+        self.num_sent += 1
+        if self.num_sent == self.crash_at:
+            if self.lose_response:
+                self.client.send_bonus(**kwargs)
+            raise RuntimeError('Connection lost')
+        return self.client.send_bonus(**kwargs)
+
+def crash_drainbonuses(crash_at, lose_response = False):
+    return mock.patch.object(drainbonuses, 'get_mturk_client', lambda requester, is_sandbox: CrashingClient(get_mturk_client(requester, is_sandbox), crash_at, lose_response))
+
+class DrainBonusesTest(FakeMTurkTestCase):
+    def test_bonuses_sent_before_a_crash_are_recorded(self):
+        audits = self.create_unpaid_audits(self.create_assignments(5))
+        for audit in audits:
+            audit.bonus = BonusPayment.objects.create(token = '%s: 4.00' % audit.assignment_id, requester_id = 'R1', worker_id = audit.assignment.worker_id, assignment = audit.assignment, amount = Decimal('4.00'), reason = 'Bonus')
+            audit.save()
+
+        with crash_drainbonuses(3):
+            with self.assertRaises(RuntimeError):
+                call_command('drainbonuses', stdout = io.StringIO(), stderr = io.StringIO())
+
+        self.assertEqual(len(self.fake.bonuses), 2)
+        paid = BonusPayment.objects.filter(status = BonusPayment.PAID)
+        self.assertEqual(set(paid.values_list('token', flat = True)), set(self.fake.bonuses.keys()))
+        self.assertEqual(AssignmentAudit.objects.filter(closed = True).count(), 2)
+
+    def test_bonus_whose_answer_was_lost_may_be_paid(self):
+        audits = self.create_unpaid_audits(self.create_assignments(3))
+        for audit in audits:
+            audit.bonus = BonusPayment.objects.create(token = '%s: 4.00' % audit.assignment_id, requester_id = 'R1', worker_id = audit.assignment.worker_id, assignment = audit.assignment, amount = Decimal('4.00'), reason = 'Bonus')
+            audit.save()
+
+        with self.settings(MTURK_MAX_RETRIES = 0), self.drop_connection('SendBonus', 'AssignmentId', 'HT1-A1'):
+            call_command('drainbonuses', stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertEqual(BonusPayment.objects.filter(status = BonusPayment.PAID).count(), 2)
+        bonus = BonusPayment.objects.get(assignment_id = 'HT1-A1')
+        self.assertEqual((bonus.status, bonus.may_be_paid), (BonusPayment.PENDING, True))
+
+class InsufficientFundsTest(FakeMTurkTestCase):
+    def drain_unfunded(self, notify_workers):
+        """
+        Runs drainbonuses for a requester who can't pay, with the fake's NotifyWorkers replaced by notify_workers
+        """
+        audits = self.create_unpaid_audits(self.create_assignments(2))
+        for audit in audits:
+            audit.bonus = BonusPayment.objects.create(token = '%s: 4.00' % audit.assignment_id, requester_id = 'R1', worker_id = audit.assignment.worker_id, assignment = audit.assignment, amount = Decimal('4.00'), reason = 'Bonus')
+            audit.save()
+        self.fake.set_balance('key-R1', '1.00')
+
+        stderr = io.StringIO()
+        with mock.patch.object(self.fake, '_op_NotifyWorkers', notify_workers):
+            call_command('drainbonuses', stdout = io.StringIO(), stderr = stderr)
+        self.assertEqual(BonusPayment.objects.filter(status = BonusPayment.UNFUNDED).count(), 2)
+        self.assertEqual(len(mail.outbox), 1)
+        return stderr.getvalue()
+
+    def test_workers_that_could_not_be_notified_are_logged(self):
+        def notify_workers(params, access_key):
+            return {'NotifyWorkersFailureStatuses': [{'NotifyWorkersFailureCode': 'HardFailure', 'NotifyWorkersFailureMessage': 'Worker blocked you', 'WorkerId': 'W1'}]}
+        self.assertIn('Could not notify W1: Worker blocked you', self.drain_unfunded(notify_workers))
+
+    def test_failed_notification_is_logged(self):
+        def notify_workers(params, access_key):
+            raise FakeMTurkError('Subject is too long.')
+        self.assertIn('Subject is too long.', self.drain_unfunded(notify_workers))
+
+class FakeMTurkTest(FakeMTurkTestCase):
+    def test_bonuses_are_listed_by_their_assignments_hit(self):
+        assignments = self.create_assignments(2, hits_per_worker = 2)
+        mturk_client = get_mturk_client(Requester.objects.get(), False)
+        for assignment in assignments:
+            mturk_client.send_bonus(WorkerId = assignment.worker_id, BonusAmount = '1.00', AssignmentId = assignment.id, Reason = 'Bonus', UniqueRequestToken = assignment.id)
+        response = mturk_client.list_bonus_payments(HITId = 'HT1-H0')
+        self.assertEqual(set(bonus['AssignmentId'] for bonus in response['BonusPayments']), {'HT1-A0', 'HT1-A1'})
+
+    def test_bonus_on_an_unknown_assignment_is_refused(self):
+        create_assignments(1)
+        mturk_client = get_mturk_client(Requester.objects.get(), False)
+        with self.assertRaises(mturk_client.exceptions.RequestError):
+            mturk_client.send_bonus(WorkerId = 'W0', BonusAmount = '1.00', AssignmentId = 'HT1-A0', Reason = 'Bonus', UniqueRequestToken = 'HT1-A0')
+        self.assertEqual(self.fake.bonuses, dict())
+
+class ClientPoolTest(TestCase):
+    def test_clients_built_concurrently_use_their_own_sessions(self):
+        requesters = [Requester(aws_account = 'R%d' % i, key = 'key-%d' % i, secret = 'secret') for i in range(8)]
+        pool = ClientPool(10)
+        clients = dict()
+        def get(requester):
+            clients[requester.aws_account] = pool.get(requester, PRODUCTION_HOST)
+
+        # boto3's default session is shared, and not thread-safe
+        with mock.patch('boto3.client', side_effect = AssertionError('built on the default session')):
+            threads = [threading.Thread(target = get, args = (requester,)) for requester in requesters]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(clients), len(requesters))
+        for requester in requesters:
+            self.assertIs(pool.get(requester, PRODUCTION_HOST), clients[requester.aws_account])
+
+class ReconcileBonusesTest(FakeMTurkTestCase):
+    def pay_after_crash(self, reconcile):
+        """
+        Pays a worker's audit, but loses MTurk's answer, then audits another of the worker's
+        assignments for the same requester and runs payaudits again
+        """
+        self.create_unpaid_audits(self.create_assignments(1, hit_type_id = 'HT1'))
+        with crash_drainbonuses(1, lose_response = True):
+            with self.assertRaises(RuntimeError):
+                call_command('payaudits', stdout = io.StringIO(), stderr = io.StringIO())
+        bonus = BonusPayment.objects.get()
+        self.assertTrue(bonus.may_be_paid)
+        self.assertEqual(bonus.status, BonusPayment.PENDING)
+
+        self.create_unpaid_audits(self.create_assignments(1, hit_type_id = 'HT2'))
+        call_command('payaudits', reconcile = reconcile, stdout = io.StringIO(), stderr = io.StringIO())
+        return bonus
+
+    def assert_paid_once(self):
+        paid = sum(Decimal(bonus['BonusAmount']) for bonus in self.fake.bonuses.values())
+        self.assertEqual(paid, auditpayments.get_underpayment(AssignmentAudit.objects.all()))
+        self.assertFalse(AssignmentAudit.objects.filter(closed = False).exists())
+        self.assertFalse(BonusPayment.objects.exclude(status = BonusPayment.PAID).exists())
+
+    def test_reconcile_runs_before_queuing(self):
+        bonus = self.pay_after_crash(reconcile = True)
+        self.assertEqual(self.fake.calls['ListBonusPayments'], 1)
+        # the lost bonus is closed as it was, and the new audit gets a bonus of its own
+        self.assertEqual(BonusPayment.objects.get(id = bonus.id).audits.count(), 1)
+        self.assertEqual(BonusPayment.objects.count(), 2)
+        self.assert_paid_once()
+
+    def test_bonus_that_may_be_paid_is_not_replaced(self):
+        bonus = self.pay_after_crash(reconcile = False)
+        # sent again under its own token, which MTurk refuses, so the new audit waits for the next run
+        self.assertEqual(BonusPayment.objects.get(id = bonus.id).status, BonusPayment.PAID)
+        self.assertEqual(AssignmentAudit.objects.filter(closed = False).count(), 1)
+        call_command('payaudits', stdout = io.StringIO(), stderr = io.StringIO())
+        self.assert_paid_once()
+
+    def test_unpaid_bonus_loses_its_mark(self):
+        self.create_unpaid_audits(self.create_assignments(2))
+        with crash_drainbonuses(1):
+            with self.assertRaises(RuntimeError):
+                call_command('payaudits', stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertEqual(BonusPayment.objects.filter(may_be_paid = True).count(), 2)
+
+        call_command('reconcilebonuses', stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertFalse(BonusPayment.objects.filter(may_be_paid = True).exists())
+        self.assertFalse(BonusPayment.objects.filter(status = BonusPayment.PAID).exists())
+
+class PayAuditsTest(FakeMTurkTestCase):
+    def test_bonus_goes_on_the_assignment_in_the_first_hit(self):
+        first = self.create_assignments(1)[0]
+        # the worker's lowest assignment id is in their second HIT
+        hit = HIT.objects.create(id = 'HT1-H1', hit_type_id = 'HT1')
+        second = Assignment.objects.create(id = 'HT1-0', hit = hit, worker_id = first.worker_id, status = Assignment.APPROVED)
+        self.fake.add_hit(hit.id, 'HT1')
+        self.fake.add_assignment(second.id, hit.id, first.worker_id, 'Approved')
+        self.create_unpaid_audits([first, second])
+
+        call_command('payaudits', stdout = io.StringIO(), stderr = io.StringIO())
+        bonus = BonusPayment.objects.get()
+        total = auditpayments.get_underpayment(AssignmentAudit.objects.all())
+        self.assertEqual(bonus.assignment_id, first.id)
+        self.assertEqual(bonus.token, '%s: %.2f' % (first.id, total))
+        self.assertEqual(list(self.fake.bonuses.keys()), [bonus.token])
+
+    def test_requeued_bonus_keeps_its_token(self):
+        self.create_unpaid_audits(self.create_assignments(1))
+        call_command('payaudits', stdout = io.StringIO(), stderr = io.StringIO())
+        token = BonusPayment.objects.get().token
+
+        # as if the bonus had been queued before BonusPayment existed, and the run had stopped before closing the audits
+        AssignmentAudit.objects.update(bonus = None, closed = False)
+        BonusPayment.objects.all().delete()
+        call_command('payaudits', stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertEqual(BonusPayment.objects.get().token, token)
+        self.assertEqual(len(self.fake.bonuses), 1)
+        self.assertFalse(AssignmentAudit.objects.filter(closed = False).exists())
+
+class DurationSummariesTest(TestCase):
+    def setUp(self):
+        # two HITs of two assignments each
+        self.assignments = create_assignments(4, hits_per_worker = 2)
+
+    def report(self, i, minutes):
+        return AssignmentDuration.objects.create(assignment = self.assignments[i], duration = timedelta(minutes = minutes))
+
+    def assert_medians(self, hit_medians, hit_type_median):
+        for hit_id, median in hit_medians.items():
+            self.assertEqual(HITDurationSummary.objects.get(hit_id = hit_id).median, median)
+        self.assertEqual(HITTypeDurationSummary.objects.get(hit_type_id = 'HT1').median, hit_type_median)
+
+    def test_reports_update_the_summaries(self):
+        self.report(0, 2)
+        self.report(1, 4)
+        report = self.report(2, 10)
+        self.assert_medians({'HT1-H0': timedelta(minutes = 3), 'HT1-H1': timedelta(minutes = 10)}, timedelta(minutes = 6.5))
+        self.assertIsNotNone(HITType.objects.get(id = 'HT1').changed)
+
+        report.duration = timedelta(minutes = 20)
+        report.save()
+        self.assert_medians({'HT1-H1': timedelta(minutes = 20)}, timedelta(minutes = 11.5))
+
+        report.delete()
+        self.assertEqual(HITDurationSummary.objects.get(hit_id = 'HT1-H1').count, 0)
+        self.assert_medians({'HT1-H0': timedelta(minutes = 3)}, timedelta(minutes = 3))
+
+    def test_frozen_workers_reports_are_left_out(self):
+        self.report(0, 2)
+        self.report(1, 4)
+        freeze = RequesterFreeze.objects.create(requester_id = 'R1', worker_id = 'W1', reason = 'Test')
+        self.assert_medians({'HT1-H0': timedelta(minutes = 2)}, timedelta(minutes = 2))
+        freeze.delete()
+        self.assert_medians({'HT1-H0': timedelta(minutes = 3)}, timedelta(minutes = 3))
+
+    def test_audits_summarize_bulk_created_reports(self):
+        # bulk_create skips the signals that keep the summaries
+        AssignmentDuration.objects.bulk_create([AssignmentDuration(assignment = self.assignments[i], duration = timedelta(minutes = minutes)) for i, minutes in [(0, 2), (1, 4)]])
+        self.assertFalse(HITDurationSummary.objects.exists())
+
+        call_command('auditpayments', stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertEqual(set(AssignmentAudit.objects.values_list('estimated_time', flat = True)), {timedelta(minutes = 3)})
+        self.assert_medians({'HT1-H0': timedelta(minutes = 3)}, timedelta(minutes = 3))
+
+    def test_populated_data_is_summarized(self):
+        fakemturk.Command(stdout = io.StringIO())._Command__populate(200, random.Random(0))
+        hits = HIT.objects.filter(hit_type__requester__aws_account__startswith = fakemturk.FAKE_REQUESTER)
+        self.assertEqual(HITDurationSummary.objects.filter(hit__in = hits, count__gt = 0).count(), hits.count())
+        self.assertEqual(HITTypeDurationSummary.objects.filter(hit_type__hit__in = hits).distinct().count(), HITType.objects.filter(hit__in = hits).distinct().count())
+        self.assertFalse(HITType.objects.filter(hit__in = hits, changed__isnull = True).exists())
+
+@override_settings(MTURK_MAX_RETRIES = 0)
+class PullNotificationsTest(FakeMTurkTestCase):
+    def throttle(self, operation, key, throttled_id):
+        return self.fail(operation, key, throttled_id, FakeMTurkError('Rate exceeded', code = 'ThrottlingException'))
+
+    def assert_failed_are_skipped(self, failed_ids, by_hit, error):
+        stderr = io.StringIO()
+        call_command('pullnotifications', by_hit = by_hit, stdout = io.StringIO(), stderr = stderr)
+        self.assertIn(error, stderr.getvalue())
+
+        # the rest are saved, and the failed ones stay due for the next run
+        for assignment in Assignment.objects.all():
+            if assignment.id in failed_ids:
+                self.assertEqual((assignment.status, assignment.next_poll_at), (Assignment.OPEN, None))
+            else:
+                self.assertEqual(assignment.status, Assignment.APPROVED)
+
+    def test_throttled_assignment_is_skipped(self):
+        self.create_assignments(5, status = Assignment.OPEN)
+        with self.throttle('GetAssignment', 'AssignmentId', 'HT1-A2'):
+            self.assert_failed_are_skipped({'HT1-A2'}, by_hit = False, error = 'Rate exceeded')
+
+    def test_throttled_hit_is_skipped(self):
+        self.create_assignments(6, status = Assignment.OPEN, hits_per_worker = 2)
+        with self.throttle('ListAssignmentsForHIT', 'HITId', 'HT1-H1'):
+            self.assert_failed_are_skipped({'HT1-A2', 'HT1-A3'}, by_hit = True, error = 'Rate exceeded')
+
+    def test_disconnected_assignment_is_skipped(self):
+        self.create_assignments(5, status = Assignment.OPEN)
+        with self.drop_connection('GetAssignment', 'AssignmentId', 'HT1-A2'):
+            self.assert_failed_are_skipped({'HT1-A2'}, by_hit = False, error = 'Connection aborted')
+
+    @override_settings(MTURK_MAX_RETRIES = 1, MTURK_RETRY_BASE_DELAY = 0)
+    def test_dropped_connection_is_retried(self):
+        self.create_assignments(5, status = Assignment.OPEN)
+        with self.drop_connection('GetAssignment', 'AssignmentId', 'HT1-A2', times = 1):
+            call_command('pullnotifications', stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertEqual(Assignment.objects.filter(status = Assignment.APPROVED).count(), 5)
+        self.assertEqual(self.fake.calls['GetAssignment'], 6)
+
+@override_settings(MTURK_POLL_INTERVAL = timedelta(minutes = 15), MTURK_MAX_POLL_INTERVAL = timedelta(days = 1), MTURK_POLL_GRANULARITY = timedelta(minutes = 5))
+class PollScheduleTest(FakeMTurkTestCase):
+    def test_backoff_grows_until_something_changes(self):
+        now = datetime(2019, 1, 1, tzinfo = timezone.utc)
+        assignment = Assignment(timestamp = now, poll_backoff = 0)
+        waits = []
+        for i in range(8):
+            next_poll_at, assignment.poll_backoff = get_next_poll(assignment, False, None, now)
+            waits.append(next_poll_at - now)
+        self.assertEqual(waits, [timedelta(minutes = 30), timedelta(hours = 1), timedelta(hours = 2), timedelta(hours = 4), timedelta(hours = 8), timedelta(hours = 16), timedelta(days = 1), timedelta(days = 1)])
+        # capped without counting any higher
+        self.assertEqual(assignment.poll_backoff, 7)
+
+        self.assertEqual(get_next_poll(assignment, True, None, now), (now + timedelta(minutes = 15), 0))
+        # checked right after it's due to be auto-approved
+        self.assertEqual(get_next_poll(assignment, False, now + timedelta(minutes = 42), now), (now + timedelta(minutes = 45), 7))
+
+    def test_all_polls_assignments_that_are_not_due(self):
+        for assignment in self.create_assignments(2, status = Assignment.SUBMITTED):
+            self.fake.set_status(assignment.id, 'Submitted')
+        Assignment.objects.update(next_poll_at = timezone.now() + timedelta(hours = 1))
+
+        call_command('pullnotifications', stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertEqual(self.fake.calls['GetAssignment'], 0)
+
+        call_command('pullnotifications', poll_all = True, stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertEqual(self.fake.calls['GetAssignment'], 2)
+        self.assertEqual(list(Assignment.objects.values_list('poll_backoff', flat = True)), [1, 1])
+
+class AuditWatermarkTest(TestCase):
+    def test_change_committed_after_a_run_started_is_audited(self):
+        create_assignments(1, hit_type_id = 'HT1')
+        run_started = timezone.now()
+        call_command('auditpayments', stdout = io.StringIO(), stderr = io.StringIO())
+
+        # approved in a transaction that stamped HT2 just before that run started, but committed after
+        assignment, = create_assignments(1, hit_type_id = 'HT2')
+        AssignmentDuration.objects.create(assignment = assignment, duration = timedelta(minutes = 12))
+        HITType.objects.filter(id = 'HT2').update(changed = run_started - timedelta(seconds = 1))
+
+        call_command('auditpayments', stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertTrue(AssignmentAudit.objects.filter(assignment = assignment).exists())
+
+class CreateHITTest(FakeMTurkTestCase):
+    def create_hit(self, assignment_id, worker_id):
+        response = self.client.post(reverse('createHIT'), {'hit_id': 'H1', 'assignment_id': assignment_id, 'worker_id': worker_id, 'aws_account': 'R1', 'host': PRODUCTION_HOST})
+        self.assertEqual(response.json()['hit_type_id'], 'HT1')
+
+    def test_known_hit_is_not_looked_up(self):
+        Requester.objects.create(aws_account = 'R1', key = 'key-R1', secret = 'secret', email = 'R1@example.com')
+        self.fake.add_hit('H1', 'HT1', reward = '1.00')
+        self.create_hit('A1', 'W1')
+        self.assertEqual(HIT.objects.get(id = 'H1').assignment_duration_seconds, self.fake.hits['H1']['AssignmentDurationInSeconds'])
+
+        with mock.patch.object(views, 'get_hit_metadata', side_effect = AssertionError('looked up a known HIT')):
+            self.create_hit('A2', 'W2')
+        self.assertEqual(set(Assignment.objects.filter(hit_id = 'H1').values_list('worker_id', flat = True)), {'W1', 'W2'})
+
+class ConsumeNotificationsTest(TestCase):
+    def consume(self, messages):
+        """
+        Runs consumenotifications --once over a file queue holding messages, a list of event lists
+        """
+        with tempfile.TemporaryDirectory() as path:
+            for i, events in enumerate(messages):
+                with open(os.path.join(path, '%03d.json' % i), 'w') as f:
+                    f.write(events if isinstance(events, str) else json.dumps({'Events': events}))
+            with self.settings(MTURK_NOTIFICATION_QUEUE = {'BACKEND': 'auditor.queues.FileQueue', 'OPTIONS': {'path': path}}):
+                call_command('consumenotifications', once = True, wait = 0, stdout = io.StringIO(), stderr = io.StringIO())
+            # every message is acknowledged, even the one that couldn't be read
+            self.assertEqual(os.listdir(path), [])
+
+    def event(self, event_type, assignment_id, timestamp):
+        return {'EventType': event_type, 'AssignmentId': assignment_id, 'EventTimestamp': timestamp}
+
+    def assert_statuses(self, statuses):
+        self.assertEqual(dict(Assignment.objects.values_list('id', 'status')), statuses)
+
+    def test_events_are_applied(self):
+        create_assignments(3, status = Assignment.OPEN)
+        self.consume([
+            [self.event('AssignmentSubmitted', 'HT1-A0', '2019-01-01T00:01:00Z'), self.event('AssignmentApproved', 'HT1-A1', '2019-01-01T00:01:00Z')],
+            [self.event('AssignmentReturned', 'HT1-A2', '2019-01-01T00:02:00Z'), self.event('AssignmentApproved', 'UNKNOWN', '2019-01-01T00:02:00Z')],
+            'not json',
+        ])
+        self.assert_statuses({'HT1-A0': Assignment.SUBMITTED, 'HT1-A1': Assignment.APPROVED, 'HT1-A2': Assignment.EXPIRED})
+        self.assertIsNotNone(HITType.objects.get(id = 'HT1').changed)
+
+    def test_stale_events_do_not_move_assignments_back(self):
+        create_assignments(2, status = Assignment.OPEN)
+        Assignment.objects.filter(id = 'HT1-A1').update(status = Assignment.APPROVED)
+        self.consume([
+            # delivered out of order: the later approval wins
+            [self.event('AssignmentApproved', 'HT1-A0', '2019-01-01T00:02:00Z')],
+            [self.event('AssignmentSubmitted', 'HT1-A0', '2019-01-01T00:01:00Z')],
+            # already approved by the time its submission arrives
+            [self.event('AssignmentSubmitted', 'HT1-A1', '2019-01-01T00:01:00Z')],
+        ])
+        self.assert_statuses({'HT1-A0': Assignment.APPROVED, 'HT1-A1': Assignment.APPROVED})
+
+        # and in a later batch, too
+        self.consume([[self.event('AssignmentSubmitted', 'HT1-A0', '2019-01-01T00:01:00Z'), self.event('AssignmentReturned', 'HT1-A1', '2019-01-01T00:03:00Z')]])
+        self.assert_statuses({'HT1-A0': Assignment.APPROVED, 'HT1-A1': Assignment.APPROVED})
+
+class SimulateWagesTest(TestCase):
+    def test_csv_for_fully_paid_and_underpaid_wages(self):
+        # $1.00 assignments: two at $5.00/hr in HT1, and one of W0's at $7.00/hr in HT2
+        for assignment in create_assignments(2, hit_type_id = 'HT1'):
+            AssignmentAudit.objects.create(assignment = assignment, estimated_time = timedelta(minutes = 12), estimated_rate = Decimal('5.00'))
+        assignment, = create_assignments(1, hit_type_id = 'HT2')
+        AssignmentAudit.objects.create(assignment = assignment, estimated_time = timedelta(minutes = 8, seconds = 34), estimated_rate = Decimal('7.00'))
+
+        stdout = io.StringIO()
+        call_command('simulatewages', wages = [5.00, 7.50], by_requester = True, stdout = stdout)
+        # at $7.50/hr W0 is owed $0.50 + $0.0714..., rounded up to the cent once for the requester
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            'wage,requester,bonus,underpaid_hit_types,underpaid_assignments',
+            '5.00,,0.00,0,0',
+            '5.00,R1,0.00,0,0',
+            '7.50,,1.08,2,3',
+            '7.50,R1,1.08,2,3',
+        ])
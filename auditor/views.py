@@ -13,7 +13,9 @@ from django.db.models import Q
 
 from .models import HITType, HIT, Worker, Assignment, AssignmentDuration, AssignmentAudit, Requester, RequesterFreeze
 from .forms import RequesterForm, FreezeForm
-from auditor.management.commands.pullnotifications import get_mturk_connection
+from .freezes import is_worker_frozen
+from auditor.management.commands.pullnotifications import get_hit_metadata
+from auditor.mturk import get_mturk_client, client_pool
 # from auditor.management.commands.auditpayments import get_salt
 from auditor.management.commands import auditpayments
 
@@ -42,30 +44,34 @@ def create_hit(request):
     reward = __get_POST_param(request, 'reward')
     r = Requester.objects.get(aws_account = aws_account)
 
-    mturk = get_mturk_connection(r, dict())
-    if 'sandbox' in host:
-        client = mturk['sandbox']
+    h = HIT.objects.filter(id = hit_id).select_related('hit_type').first()
+    if h is not None:
+        # another worker already registered it, so there's nothing to ask MTurk
+        ht = h.hit_type
     else:
-        client = mturk['production']
-
-    response = client.get_hit(HITId=hit_id)
-
-    if reward is None:
-        reward = response['HIT']['Reward']
-    if hit_type_id is None:
-        hit_type_id = response['HIT']['HITTypeId']
-
-    ht, ht_created = HITType.objects.get_or_create(
-        id = hit_type_id,
-        payment = reward,
-        host = host,
-        requester = r
-    )
-
-    h, h_created = HIT.objects.get_or_create(
-        id = hit_id,
-        hit_type = ht
-    )
+        client = get_mturk_client(r, 'sandbox' in host)
+
+        hit_metadata = get_hit_metadata(client, host, hit_id)
+
+        if reward is None:
+            reward = hit_metadata['Reward']
+        if hit_type_id is None:
+            hit_type_id = hit_metadata['HITTypeId']
+
+        ht, ht_created = HITType.objects.get_or_create(
+            id = hit_type_id,
+            payment = reward,
+            host = host,
+            requester = r
+        )
+
+        h, h_created = HIT.objects.get_or_create(
+            id = hit_id,
+            hit_type = ht
+        )
+        if h.assignment_duration_seconds is None:
+            h.assignment_duration_seconds = hit_metadata['AssignmentDurationInSeconds']
+            h.save()
     w, w_created = Worker.objects.get_or_create(
         id = worker_id
     )
@@ -252,7 +258,7 @@ def freeze(request, requester, worker_signed):
     status_durations = dict()
 
     for status in statuses:
-        audits = AssignmentAudit.objects.filter(assignment__hit__hit_type__requester = requester_object).filter(message_sent__isnull = False)
+        audits = AssignmentAudit.objects.filter(requester = requester_object).filter(message_sent__isnull = False)
         if status == 'pending':
             audits = audits.filter(closed=False).filter(needsPayment=True)
         elif status == 'completed':
@@ -286,29 +292,17 @@ def freeze(request, requester, worker_signed):
         form = FreezeForm(request.POST)
         # check whether it's valid:
         if form.is_valid():
-            freeze = RequesterFreeze(worker=worker, requester=requester_object, reason=form.cleaned_data['reason'])
-            freeze.save()
+            # freezing again just updates the reason
+            RequesterFreeze.objects.update_or_create(worker=worker, requester=requester_object, defaults={'reason': form.cleaned_data['reason']})
             # set assignment audit as frozen here
-            to_freeze = Assignment.objects.filter(worker=worker).filter(hit__hit_type__requester_id = requester_object)
-
-            for assignmentaudit in AssignmentAudit.objects.filter(closed=False):
-                for assignment in to_freeze:
-                    if assignment.id == assignmentaudit.assignment_id:
-                        assignmentaudit.frozen = True
-                        assignmentaudit.save()
-                        break
+            AssignmentAudit.objects.filter(closed=False).filter(requester=requester_object).filter(assignment__worker=worker).update(frozen=True)
 
             # show banner to requester saying that you froze worker
             # send email to worker saying you're frozen
             # need to get some sort of Mturk object...
 
-            mturk_clients = get_mturk_connection(requester_object, dict())
-
             for is_sandbox in [True, False]:
-                if is_sandbox:
-                    mturk_client = mturk_clients['sandbox']
-                else:
-                    mturk_client = mturk_clients['production']
+                mturk_client = get_mturk_client(requester_object, is_sandbox)
 
                 try:
                     subject = "Fair Work Payments Frozen"
@@ -321,33 +315,23 @@ def freeze(request, requester, worker_signed):
                 except mturk_client.exceptions.RequestError as e:
                     print(e)
 
-            call_command('auditpayments')
+            call_command('auditpayments', workers = 1) # don't fork the web server
 
     elif request.method == 'POST' and 'delete' in request.POST.keys():
         form = FreezeForm()
 
         RequesterFreeze.objects.filter(worker=worker, requester=requester_object).delete()
 
-        to_unfreeze = Assignment.objects.filter(worker=worker).filter(hit__hit_type__requester_id = requester_object)
-
-        for assignmentaudit in AssignmentAudit.objects.filter(closed=False).filter(frozen=True):
-            for assignment in to_unfreeze:
-                if assignment.id == assignmentaudit.assignment_id:
-                    assignmentaudit.frozen = False
-                    assignmentaudit.save()
-                    break
+        AssignmentAudit.objects.filter(closed=False).filter(frozen=True).filter(requester=requester_object).filter(assignment__worker=worker).update(frozen=False)
 
-        call_command('auditpayments')
+        call_command('auditpayments', workers = 1) # don't fork the web server
         # show banner to requester saying that you unfroze worker
         # send email to worker saying you're unfrozen
 
     else:
         form = FreezeForm()
 
-    frozen = False
-    if RequesterFreeze.objects.filter(worker=worker, requester=requester).count() > 0:
-        # there's a freeze in place
-        frozen = True
+    frozen = is_worker_frozen(requester_object.aws_account, worker.id)
 
     context = {
         'requester': requester,
@@ -393,6 +377,7 @@ def __create_or_update_requester(aws_account, key, secret, email):
         r.key = key
         r.secret = secret
         r.save()
+        client_pool.invalidate(aws_account)
     if email != r.email:
         r.email = email
         r.save()
\ No newline at end of file